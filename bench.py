@@ -0,0 +1,531 @@
+import argparse
+import asyncio
+import logging
+import os
+import random
+import resource
+import statistics
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.parse
+
+import yt_dlp
+
+from discord.opus import Encoder
+
+import main
+
+FRAMES_PER_SECOND = 50
+
+def resolve_stream(url):
+    opts = main.get_ytdl_opts()
+    opts["format"] = "bestaudio[acodec=opus]/bestaudio"
+    audio = main._extract_audio_url(opts, url)
+    if not audio:
+        raise SystemExit(f"❌ Не удалось получить поток для {url}")
+    return audio["url"], audio.get("acodec")
+
+def children_cpu():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+def measure_source(url, codec, seconds):
+    cpu_children_start = children_cpu()
+    cpu_self_start = time.process_time()
+    wall_start = time.perf_counter()
+
+    source = main.create_source(url, codec)
+    encoder = None if source.is_opus() else Encoder()
+
+    frames = 0
+    while frames < seconds * FRAMES_PER_SECOND:
+        data = source.read()
+        if not data:
+            break
+        if encoder:
+            encoder.encode(data, encoder.SAMPLES_PER_FRAME)
+        frames += 1
+
+    source.cleanup()
+
+    audio_seconds = frames / FRAMES_PER_SECOND
+    cpu_self = time.process_time() - cpu_self_start
+    cpu_ffmpeg = children_cpu() - cpu_children_start
+
+    return {
+        "path": "opus" if source.is_opus() else "pcm",
+        "audio_seconds": audio_seconds,
+        "wall": time.perf_counter() - wall_start,
+        "cpu_self": cpu_self,
+        "cpu_ffmpeg": cpu_ffmpeg,
+        "cpu_per_audio_second": (cpu_self + cpu_ffmpeg) / audio_seconds if audio_seconds else 0,
+    }
+
+def print_results(results):
+    print(f"{'путь':<6} {'аудио, с':>9} {'wall, с':>8} {'CPU бот':>8} {'CPU ffmpeg':>11} {'CPU/с аудио':>12}")
+    for r in results:
+        print(
+            f"{r['path']:<6} {r['audio_seconds']:>9.1f} {r['wall']:>8.2f} {r['cpu_self']:>8.2f} "
+            f"{r['cpu_ffmpeg']:>11.2f} {r['cpu_per_audio_second'] * 100:>11.2f}%"
+        )
+
+def bench_opus(args):
+    url, codec = (args.source, args.codec)
+    if args.resolve:
+        url, codec = resolve_stream(args.source)
+
+    if codec != "opus":
+        print(f"⚠️ Кодек источника {codec}: passthrough недоступен, оба замера пойдут через PCM")
+
+    main.OPUS_PASSTHROUGH = True
+    results = [
+        measure_source(url, None, args.seconds),
+        measure_source(url, codec, args.seconds),
+    ]
+    print_results(results)
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def pace_source(source, seconds, encode, results):
+    # Повторяет цикл discord.py AudioPlayer: чтение кадра, кодирование, ожидание до следующего тика
+    encoder = Encoder() if encode and not source.is_opus() else None
+    delay = 1 / FRAMES_PER_SECOND
+    jitter = []
+    late = 0
+    start = time.perf_counter()
+
+    for loops in range(1, seconds * FRAMES_PER_SECOND + 1):
+        data = source.read()
+        if not data:
+            break
+        if encoder:
+            encoder.encode(data, encoder.SAMPLES_PER_FRAME)
+
+        sent_at = time.perf_counter()
+        lateness = sent_at - (start + delay * (loops - 1))
+        jitter.append(max(0, lateness) * 1000)
+        if lateness > delay:
+            late += 1
+
+        time.sleep(max(0, start + delay * loops - time.perf_counter()))
+
+    source.cleanup()
+    results.append({"jitter": jitter, "late": late})
+
+def measure_jitter(url, codec, guilds, seconds, local):
+    sources = [main.create_source(url, codec, local=local) for _ in range(guilds)]
+    results = []
+    threads = [
+        threading.Thread(target=pace_source, args=(source, seconds, True, results), daemon=True)
+        for source in sources
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    jitter = [value for result in results for value in result["jitter"]]
+    frames = len(jitter)
+    return {
+        "guilds": guilds,
+        "frames": frames,
+        "p50": percentile(jitter, 50),
+        "p99": percentile(jitter, 99),
+        "max": max(jitter, default=0),
+        "stdev": statistics.pstdev(jitter) if jitter else 0,
+        "late": sum(result["late"] for result in results) / frames * 100 if frames else 0,
+    }
+
+def bench_frames(args):
+    url, codec = (args.source, args.codec)
+    if args.resolve:
+        url, codec = resolve_stream(args.source)
+
+    main.audio_workers = main.AudioWorkerPool(args.workers)
+    mode = f"аудиоворкеры: {args.workers}" if args.workers else "в процессе бота"
+    print(f"🎛️ Режим: {mode}, кодек {codec}, {args.seconds} с на замер")
+    print(f"{'гильдий':>8} {'кадров':>8} {'p50, мс':>8} {'p99, мс':>8} {'max, мс':>8} {'σ, мс':>7} {'опоздания':>10}")
+
+    try:
+        for guilds in args.guilds:
+            r = measure_jitter(url, codec, guilds, args.seconds, args.local)
+            print(
+                f"{r['guilds']:>8} {r['frames']:>8} {r['p50']:>8.2f} {r['p99']:>8.2f} "
+                f"{r['max']:>8.2f} {r['stdev']:>7.2f} {r['late']:>9.2f}%"
+            )
+    finally:
+        main.audio_workers.shutdown()
+
+class FakeExtractor:
+    """Заменяет yt-dlp: отдает синтетические видео и плейлисты с заданной задержкой и долей ошибок"""
+
+    def __init__(self, latency, failure_rate, track_seconds, playlist_size, seed):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.track_seconds = track_seconds
+        self.playlist_size = playlist_size
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = {"search": 0, "playlist": 0, "video": 0, "failed": 0}
+
+    def __call__(self, opts):
+        return FakeYoutubeDL(self, opts)
+
+    def video(self, video_id):
+        url = f"https://www.youtube.com/watch?v={video_id}"
+        expire = int(time.time()) + 6 * 3600
+        stream_url = f"https://fake.invalid/{video_id}.webm?expire={expire}&dur={self.track_seconds}"
+        return {
+            "id": video_id,
+            "title": f"Трек {video_id}",
+            "url": stream_url,
+            "webpage_url": url,
+            "thumbnail": "",
+            "duration": self.track_seconds,
+            "formats": [{"url": stream_url, "acodec": "opus", "vcodec": "none", "ext": "webm"}],
+        }
+
+    def extract(self, url, opts, process=True):
+        with self.lock:
+            delay = self.random.uniform(self.latency * 0.5, self.latency * 1.5)
+            failed = self.random.random() < self.failure_rate
+        time.sleep(delay)
+
+        if failed:
+            with self.lock:
+                self.calls["failed"] += 1
+            raise yt_dlp.utils.DownloadError("HTTP Error 503: симуляция сбоя")
+
+        if url.startswith("ytsearch"):
+            kind = "search"
+            query = url.split(":", 1)[1]
+            info = {"title": query, "entries": [self.video(f"v{abs(hash(query)) % 10 ** 9:010d}")]}
+        elif "list=" in url:
+            kind = "playlist"
+            playlist_id = urllib.parse.parse_qs(urllib.parse.urlparse(url).query)["list"][0]
+            count = min(self.playlist_size, opts.get("playlistend") or self.playlist_size)
+            entries = self.playlist_entries(playlist_id, count, opts.get("extract_flat"))
+            info = {"title": f"Плейлист {playlist_id}", "entries": entries if not process else list(entries)}
+        else:
+            kind = "video"
+            info = self.video(urllib.parse.parse_qs(urllib.parse.urlparse(url).query)["v"][0])
+
+        with self.lock:
+            self.calls[kind] += 1
+        return info
+
+    def playlist_entries(self, playlist_id, count, flat, page_size=5):
+        for i in range(count):
+            # Как у YouTube: следующая страница плейлиста - отдельный запрос
+            if i and i % page_size == 0:
+                time.sleep(self.latency)
+            entry = self.video(f"{playlist_id}x{i:04d}")
+            if flat:
+                entry = {
+                    "id": entry["id"], "title": entry["title"],
+                    "url": entry["webpage_url"], "duration": entry["duration"],
+                }
+            yield entry
+
+class FakeYoutubeDL:
+    def __init__(self, extractor, opts):
+        self.extractor = extractor
+        self.opts = opts
+
+    def extract_info(self, url, download=False, process=True):
+        return self.extractor.extract(url, self.opts, process)
+
+class FakeAudio:
+    def __init__(self, frames):
+        self.remaining = frames
+
+    def read(self):
+        if self.remaining <= 0:
+            return b""
+        self.remaining -= 1
+        return b"\xf8\xff\xfe"
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        pass
+
+def fake_create_source(url, codec=None, start=0, local=False):
+    duration = float(urllib.parse.parse_qs(urllib.parse.urlparse(url).query)["dur"][0])
+    frames = int(max(0, duration - start) * FRAMES_PER_SECOND)
+    return main.PlaybackSource(FakeAudio(frames), start)
+
+class OfflineStats:
+    def __init__(self):
+        self.first_audio = []
+        self.gaps = []
+        self.skip_gaps = []
+        self.actions = {"play": 0, "playlist": 0, "skip": 0}
+
+class FakeVoiceClient:
+    def __init__(self, guild, stats, track_seconds):
+        self.guild = guild
+        self.stats = stats
+        self.track_seconds = track_seconds
+        self.source = None
+        self.after = None
+        self.timer = None
+        self.paused = False
+        self.requested_at = None
+        self.ended_at = None
+        self.skipped = False
+
+    def is_connected(self):
+        return True
+
+    def is_playing(self):
+        return self.source is not None and not self.paused
+
+    def is_paused(self):
+        return self.source is not None and self.paused
+
+    def play(self, source, after=None):
+        now = time.perf_counter()
+        if self.requested_at is not None:
+            self.stats.first_audio.append(now - self.requested_at)
+        elif self.ended_at is not None:
+            (self.stats.skip_gaps if self.skipped else self.stats.gaps).append(now - self.ended_at)
+        self.requested_at = self.ended_at = None
+
+        self.source, self.after, self.paused = source, after, False
+        source.read()
+        self.timer = asyncio.get_running_loop().call_later(self.track_seconds, self._finish, False)
+
+    def _finish(self, skipped):
+        source, after = self.source, self.after
+        self.source = self.after = self.timer = None
+        if not skipped:
+            while source.read():
+                pass
+        source.cleanup()
+
+        self.skipped = skipped
+        self.ended_at = time.perf_counter()
+        if after:
+            after(None)
+
+    def stop(self):
+        if self.timer:
+            self.timer.cancel()
+            self._finish(True)
+
+    def pause(self):
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+
+    async def disconnect(self, force=False):
+        self.stop()
+
+class FakeMessage:
+    def __init__(self, channel):
+        self.id = random.getrandbits(48)
+        self.channel = channel
+        self.guild = channel.guild
+
+    async def edit(self, **kwargs):
+        pass
+
+    async def delete(self):
+        pass
+
+class FakeChannel:
+    def __init__(self, guild):
+        self.id = guild.id
+        self.guild = guild
+
+    async def send(self, *args, **kwargs):
+        return FakeMessage(self)
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+        self.name = f"guild-{guild_id}"
+        self.voice_client = None
+        self.shard_id = 0
+
+class FakeResponse:
+    async def send_message(self, *args, **kwargs):
+        pass
+
+    async def defer(self, *args, **kwargs):
+        pass
+
+class FakeUser:
+    def __init__(self, name):
+        self.name = name
+        self.voice = None
+
+class FakeInteraction:
+    def __init__(self, guild, user, channel):
+        self.guild = guild
+        self.user = user
+        self.channel = channel
+        self.response = FakeResponse()
+
+    async def edit_original_response(self, **kwargs):
+        pass
+
+async def simulate_guild(index, args, stats, deadline):
+    rng = random.Random(args.seed + index)
+    guild = FakeGuild(10 ** 17 + index)
+    guild.voice_client = vc = FakeVoiceClient(guild, stats, args.track_seconds)
+    interaction = FakeInteraction(guild, FakeUser(f"user-{index}"), FakeChannel(guild))
+    catalog = range(args.catalog)
+    # Популярность треков по закону Ципфа, чтобы кэш работал как в проде
+    weights = [1 / (rank + 1) for rank in catalog]
+
+    while time.perf_counter() < deadline:
+        action = rng.choices(["play", "playlist", "skip"], weights=[args.play_weight, args.playlist_weight, args.skip_weight])[0]
+
+        if action == "skip":
+            if vc.is_playing():
+                stats.actions["skip"] += 1
+                await main.skip.callback(interaction)
+        else:
+            if action == "playlist":
+                query = f"https://www.youtube.com/playlist?list=PL{rng.randrange(args.playlists):04d}"
+            else:
+                query = f"трек {rng.choices(catalog, weights=weights)[0]}"
+
+            stats.actions[action] += 1
+            if not vc.is_playing():
+                vc.requested_at = time.perf_counter()
+            await main.play.callback(interaction, query)
+
+        await asyncio.sleep(rng.expovariate(1 / args.think))
+
+def isolate_cache(path):
+    cache = main.cache_manager
+    if cache.conn:
+        with cache.db_lock:
+            cache.conn.close()
+        cache.conn = None
+    with cache.cache_lock:
+        cache.memory_cache.clear()
+        cache.memory_bytes = 0
+        cache.pending_writes.clear()
+    cache.db_path = path
+    cache.init_db()
+
+def format_ms(values):
+    if not values:
+        return "—"
+    return f"p50 {percentile(values, 50) * 1000:.0f} мс, p99 {percentile(values, 99) * 1000:.0f} мс, n={len(values)}"
+
+async def run_offline(args, extractor, stats):
+    main.bot.loop = asyncio.get_running_loop()
+    deadline = time.perf_counter() + args.duration
+    guilds = [asyncio.create_task(simulate_guild(i, args, stats, deadline)) for i in range(args.guilds)]
+    done, pending = await asyncio.wait(guilds, timeout=args.duration + 30)
+    for task in pending:
+        task.cancel()
+    for task in done:
+        if task.exception():
+            print(f"⚠️ Гильдия завершилась с ошибкой: {task.exception()!r}")
+    if pending:
+        print(f"⚠️ {len(pending)} гильдий не завершились вовремя")
+
+def bench_offline(args):
+    if not args.verbose:
+        logging.getLogger("VexelBot").setLevel(logging.CRITICAL)
+
+    extractor = FakeExtractor(args.latency, args.failure_rate, args.track_seconds, args.playlist_size, args.seed)
+    main.ytdl_pool.backend = main.ThreadExtractionBackend(extractor)
+    main.create_source = fake_create_source
+    main.audio_workers = main.AudioWorkerPool(0)
+
+    stats = OfflineStats()
+    with tempfile.TemporaryDirectory() as directory:
+        isolate_cache(os.path.join(directory, "bench_cache.db"))
+        tracemalloc.start()
+        wall_start = time.perf_counter()
+        asyncio.run(run_offline(args, extractor, stats))
+        wall = time.perf_counter() - wall_start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        cache_stats = main.cache_manager.get_stats()
+        with main.metrics.lock:
+            prefixes = dict(main.metrics.counters)
+
+    lookups = cache_stats["hits"] + cache_stats["misses"]
+    print(f"🧪 {args.guilds} гильдий, {wall:.0f} с, задержка yt-dlp {args.latency * 1000:.0f} мс, ошибки {args.failure_rate:.0%}")
+    print(f"Действия: {stats.actions}")
+    print(f"Вызовы yt-dlp: {extractor.calls}")
+    print(f"Время до первого звука: {format_ms(stats.first_audio)}")
+    print(f"Пауза между треками: {format_ms(stats.gaps)}")
+    print(f"Пауза после скипа: {format_ms(stats.skip_gaps)}")
+    print(
+        f"Память: пик Python {peak / 1024 / 1024:.1f} МБ, "
+        f"RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} МБ, "
+        f"кэш {cache_stats['entries']} записей / {cache_stats['bytes'] // 1024} КБ"
+    )
+    print(f"Кэш: {cache_stats['hits'] / lookups:.1%} попаданий из {lookups}" if lookups else "Кэш: обращений не было")
+    for (name, labels), value in sorted(prefixes.items()):
+        if name == "vexel_cache_requests_total":
+            print(f"  {dict(labels)['prefix']:<12} {dict(labels)['result']:<7} {value}")
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Бенчмарки Vexel Music Bot")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    opus = subparsers.add_parser("opus", help="CPU на поток: PCM + кодирование в боте против Opus passthrough")
+    opus.add_argument("source", help="URL страницы (с --resolve), прямой URL потока или локальный файл")
+    opus.add_argument("--resolve", action="store_true", help="получить поток через yt-dlp")
+    opus.add_argument("--codec", default="opus", help="кодек источника без --resolve")
+    opus.add_argument("--seconds", type=int, default=60, help="сколько секунд аудио читать")
+    opus.set_defaults(func=bench_opus)
+
+    frames = subparsers.add_parser("frames", help="джиттер отправки кадров в зависимости от числа гильдий")
+    frames.add_argument("source", help="URL страницы (с --resolve), прямой URL потока или локальный файл")
+    frames.add_argument("--resolve", action="store_true", help="получить поток через yt-dlp")
+    frames.add_argument("--codec", default="opus", help="кодек источника без --resolve")
+    frames.add_argument("--local", action="store_true", help="источник - локальный файл")
+    frames.add_argument("--workers", type=int, default=0, help="число аудиоворкеров, 0 - кодирование в процессе бота")
+    frames.add_argument(
+        "--guilds", type=lambda v: [int(x) for x in v.split(",")], default=[1, 5, 10, 25, 50],
+        help="список числа одновременных гильдий через запятую"
+    )
+    frames.add_argument("--seconds", type=int, default=30, help="сколько секунд аудио на каждый замер")
+    frames.set_defaults(func=bench_frames)
+
+    offline = subparsers.add_parser("offline", help="симуляция гильдий без сети и Discord")
+    offline.add_argument("--guilds", type=int, default=20, help="число одновременных гильдий")
+    offline.add_argument("--duration", type=int, default=90, help="длительность симуляции, с")
+    offline.add_argument("--latency", type=float, default=0.8, help="средняя задержка yt-dlp, с")
+    offline.add_argument("--failure-rate", type=float, default=0.05, help="доля вызовов yt-dlp с ошибкой")
+    offline.add_argument("--track-seconds", type=float, default=25, help="длительность трека")
+    offline.add_argument("--catalog", type=int, default=200, help="число разных треков для поиска")
+    offline.add_argument("--playlists", type=int, default=20, help="число разных плейлистов")
+    offline.add_argument("--playlist-size", type=int, default=15, help="треков в плейлисте")
+    offline.add_argument("--think", type=float, default=8, help="средняя пауза между действиями пользователя, с")
+    offline.add_argument("--play-weight", type=float, default=6, help="вес действия /play")
+    offline.add_argument("--playlist-weight", type=float, default=1, help="вес добавления плейлиста")
+    offline.add_argument("--skip-weight", type=float, default=3, help="вес действия skip")
+    offline.add_argument("--seed", type=int, default=1, help="seed генератора")
+    offline.add_argument("--verbose", action="store_true", help="не глушить логи бота")
+    offline.set_defaults(func=bench_offline)
+
+    return parser
+
+if __name__ == "__main__":
+    args = build_parser().parse_args()
+    try:
+        args.func(args)
+    finally:
+        main.ytdl_pool.shutdown(wait=False)
+        main.cache_manager.close()
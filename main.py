@@ -8,14 +8,71 @@ import sqlite3
 import json
 import time
 import threading
+import zlib
+import functools
+import itertools
+import copy
+import urllib.parse
+import signal
+import subprocess
+import socket
+import traceback
 from discord.ext import commands
 from discord import app_commands
 import yt_dlp
-from concurrent.futures import ThreadPoolExecutor
+import workers
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from multiprocessing.connection import Connection
 
 TOKEN = os.getenv("DISCORD_TOKEN")
-MAX_PLAYLIST_SIZE = int(os.getenv("MAX_PLAYLIST_SIZE", "15"))
-MAX_QUEUE_SIZE = int(os.getenv("MAX_QUEUE_SIZE", "50"))
+MAX_PLAYLIST_SIZE = int(os.getenv("MAX_PLAYLIST_SIZE", "500"))
+MAX_QUEUE_SIZE = int(os.getenv("MAX_QUEUE_SIZE", "1000"))
+QUEUE_WINDOW = int(os.getenv("QUEUE_WINDOW", "10"))
+QUEUE_PAGE_SIZE = 10
+OPUS_PASSTHROUGH = os.getenv("OPUS_PASSTHROUGH", "true").lower() == "true"
+PLAYER_UPDATE_INTERVAL = float(os.getenv("PLAYER_UPDATE_INTERVAL", "2"))
+PLAYER_RESEND_AFTER = int(os.getenv("PLAYER_RESEND_AFTER", "5"))
+STATE_SAVE_INTERVAL = float(os.getenv("STATE_SAVE_INTERVAL", "5"))
+STATE_POSITION_INTERVAL = int(os.getenv("STATE_POSITION_INTERVAL", "30"))
+GAPLESS_PLAYBACK = os.getenv("GAPLESS_PLAYBACK", "true").lower() == "true"
+GAPLESS_LEAD_SECONDS = int(os.getenv("GAPLESS_LEAD_SECONDS", "20"))
+AUDIO_URL_DEFAULT_TTL = int(os.getenv("AUDIO_URL_DEFAULT_TTL", "1800"))
+AUDIO_URL_EXPIRY_MARGIN = int(os.getenv("AUDIO_URL_EXPIRY_MARGIN", "300"))
+STREAM_MAX_RETRIES = int(os.getenv("STREAM_MAX_RETRIES", "2"))
+AUDIO_URL_RETRIES = int(os.getenv("AUDIO_URL_RETRIES", "1"))
+AUDIO_CACHE_ENABLED = os.getenv("AUDIO_CACHE_ENABLED", "false").lower() == "true"
+AUDIO_CACHE_DIR = os.getenv("AUDIO_CACHE_DIR", "/app/cache/audio")
+AUDIO_CACHE_MAX_MB = int(os.getenv("AUDIO_CACHE_MAX_MB", "2048"))
+AUDIO_CACHE_MIN_PLAYS = int(os.getenv("AUDIO_CACHE_MIN_PLAYS", "3"))
+CACHE_WARMUP_TOP = int(os.getenv("CACHE_WARMUP_TOP", "50"))
+CACHE_WARMUP_INTERVAL = int(os.getenv("CACHE_WARMUP_INTERVAL", "1800"))
+CACHE_WARMUP_DAYS = int(os.getenv("CACHE_WARMUP_DAYS", "30"))
+CACHE_WARMUP_CONCURRENCY = int(os.getenv("CACHE_WARMUP_CONCURRENCY", "2"))
+YTDLP_WORKERS = int(os.getenv("YTDLP_WORKERS", "6"))
+EXTRACTION_BACKEND = os.getenv("EXTRACTION_BACKEND", "thread").lower()
+EXTRACTION_MAX_JOBS = int(os.getenv("EXTRACTION_MAX_JOBS", "200"))
+EXTRACTION_TIMEOUT = float(os.getenv("EXTRACTION_TIMEOUT", "120"))
+EXTRACTION_DOWNLOAD_TIMEOUT = float(os.getenv("EXTRACTION_DOWNLOAD_TIMEOUT", "1800"))
+EXTRACTION_HEALTH_INTERVAL = int(os.getenv("EXTRACTION_HEALTH_INTERVAL", "30"))
+PRELOAD_ON_ADD = int(os.getenv("PRELOAD_ON_ADD", "3"))
+PRELOAD_ON_NEXT = int(os.getenv("PRELOAD_ON_NEXT", "2"))
+PRELOAD_IMMEDIATE = int(os.getenv("PRELOAD_IMMEDIATE", "1"))
+PRELOAD_SAFETY_FACTOR = float(os.getenv("PRELOAD_SAFETY_FACTOR", "2"))
+PRELOAD_SAFETY_SECONDS = float(os.getenv("PRELOAD_SAFETY_SECONDS", "10"))
+CACHE_MEMORY_MAX_ENTRIES = int(os.getenv("CACHE_MEMORY_MAX_ENTRIES", "2000"))
+CACHE_MEMORY_MAX_MB = int(os.getenv("CACHE_MEMORY_MAX_MB", "64"))
+AUDIO_WORKERS = int(os.getenv("AUDIO_WORKERS", "0"))
+AUDIO_WORKER_BUFFER_FRAMES = int(os.getenv("AUDIO_WORKER_BUFFER_FRAMES", "250"))
+AUDIO_WORKER_READ_TIMEOUT = float(os.getenv("AUDIO_WORKER_READ_TIMEOUT", "5"))
+BOT_PROCESSES = int(os.getenv("BOT_PROCESSES", "1"))
+SHARD_COUNT = int(os.getenv("SHARD_COUNT") or 0) or None
+SHARD_IDS = os.getenv("SHARD_IDS")
+SHARD_STATS_INTERVAL = int(os.getenv("SHARD_STATS_INTERVAL", "30"))
+LOOP_WATCHDOG = os.getenv("LOOP_WATCHDOG", "true").lower() == "true"
+LOOP_LAG_THRESHOLD = float(os.getenv("LOOP_LAG_THRESHOLD", "0.25"))
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
 
 logging.basicConfig(
     level=logging.INFO,
@@ -30,7 +87,25 @@ intents.message_content = True
 intents.voice_states = True
 intents.guilds = True
 
-bot = commands.Bot(command_prefix="/", intents=intents)
+def parse_shard_ids(value):
+    shard_ids = []
+    for part in value.split(","):
+        if "-" in part:
+            start, end = part.split("-")
+            shard_ids.extend(range(int(start), int(end) + 1))
+        elif part.strip():
+            shard_ids.append(int(part))
+    return shard_ids
+
+if SHARD_COUNT or SHARD_IDS or os.getenv("AUTO_SHARDING", "false").lower() == "true":
+    bot = commands.AutoShardedBot(
+        command_prefix="/",
+        intents=intents,
+        shard_count=SHARD_COUNT,
+        shard_ids=parse_shard_ids(SHARD_IDS) if SHARD_IDS else None
+    )
+else:
+    bot = commands.Bot(command_prefix="/", intents=intents)
 tree = bot.tree
 
 queues = {}
@@ -39,6 +114,479 @@ current_tracks = {}
 player_channels = {}
 track_history = {}
 play_next_locks = {}
+staged_sources = {}
+staging_tasks = {}
+transition_starts = {}
+playing_sources = {}
+
+TRACK_RECORD_VERSION = 1
+TRACK_FIELDS = ("id", "title", "url", "webpage_url", "thumbnail", "duration")
+STATE_FIELDS = TRACK_FIELDS + ("requester", "playlist_url", "playlist_index", "lazy_load", "loaded")
+
+def make_track_record(info):
+    thumbnail = info.get("thumbnail")
+    if not thumbnail and info.get("thumbnails"):
+        thumbnail = info["thumbnails"][-1].get("url")
+    
+    return {
+        "v": TRACK_RECORD_VERSION,
+        "id": info.get("id"),
+        "title": info.get("title") or "Unknown Track",
+        "url": info.get("url", ""),
+        "webpage_url": info.get("webpage_url", ""),
+        "thumbnail": thumbnail or "",
+        "duration": info.get("duration"),
+    }
+
+def make_search_record(info):
+    if "entries" in info:
+        return {
+            "v": TRACK_RECORD_VERSION,
+            "title": info.get("title"),
+            "entries": [make_track_record(entry) for entry in info["entries"] if entry],
+        }
+    return make_track_record(info)
+
+def valid_record(data):
+    if isinstance(data, dict) and data.get("v") == TRACK_RECORD_VERSION:
+        return data
+    return None
+
+def track_cache_key(key):
+    return f"track_full:{key}"
+
+YOUTUBE_HOSTS = ("youtube.com", "www.youtube.com", "m.youtube.com", "music.youtube.com")
+VIDEO_ID_RE = re.compile(r"^[\w-]{11}$")
+
+def extract_video_id(url):
+    if not url:
+        return None
+    
+    parsed = urllib.parse.urlparse(url)
+    host = (parsed.hostname or "").lower()
+    
+    if host in ("youtu.be", "www.youtu.be"):
+        candidate = parsed.path.lstrip("/").split("/")[0]
+    elif host in YOUTUBE_HOSTS:
+        if parsed.path == "/watch":
+            candidate = urllib.parse.parse_qs(parsed.query).get("v", [""])[0]
+        else:
+            parts = parsed.path.strip("/").split("/")
+            candidate = parts[1] if len(parts) > 1 and parts[0] in ("shorts", "embed", "live", "v") else ""
+    else:
+        return None
+    
+    return candidate if VIDEO_ID_RE.match(candidate) else None
+
+def canonical_video_url(video_id):
+    return f"https://www.youtube.com/watch?v={video_id}"
+
+def canonical_query(query):
+    query = query.strip()
+    if not query.startswith(("http://", "https://")):
+        return f"ytsearch1:{' '.join(clean_search_query(query).casefold().split())}"
+    
+    parsed = urllib.parse.urlparse(query)
+    if (parsed.hostname or "").lower() in YOUTUBE_HOSTS + ("youtu.be", "www.youtu.be"):
+        playlist_id = urllib.parse.parse_qs(parsed.query).get("list", [""])[0]
+        video_id = extract_video_id(query)
+        if playlist_id.startswith("RD"):
+            # Миксы и радио собираются только вокруг исходного видео, v отбрасывать нельзя
+            if video_id:
+                return f"{canonical_video_url(video_id)}&list={playlist_id}"
+            return query
+        if playlist_id:
+            return f"https://www.youtube.com/playlist?list={playlist_id}"
+        
+        if video_id:
+            return canonical_video_url(video_id)
+    
+    return query
+
+def audio_url_cache_key(track_url):
+    return f"audio_url:{extract_video_id(track_url) or track_url}"
+
+class Track:
+    __slots__ = (
+        "id", "title", "url", "webpage_url", "thumbnail", "duration", "requester",
+        "playlist_url", "playlist_index", "lazy_load", "loaded", "preloading", "stream_retries",
+        "resume_at", "stream_expires",
+    )
+    
+    def __init__(self, title, requester, id=None, url="", webpage_url="", thumbnail="",
+                 duration=None, playlist_url=None, playlist_index=None, lazy_load=False):
+        self.id = id
+        self.title = title
+        self.url = url
+        self.webpage_url = webpage_url
+        self.thumbnail = thumbnail
+        self.duration = duration
+        self.requester = requester
+        self.playlist_url = playlist_url
+        self.playlist_index = playlist_index
+        self.lazy_load = lazy_load
+        self.loaded = not lazy_load
+        self.preloading = False
+        self.stream_retries = 0
+        self.resume_at = 0
+        self.stream_expires = 0
+    
+    @classmethod
+    def from_state(cls, data):
+        track = cls(data.get("title") or "Unknown Track", data.get("requester") or "")
+        for field in STATE_FIELDS:
+            if field in data:
+                setattr(track, field, data[field])
+        return track
+    
+    def to_state(self):
+        return {field: getattr(self, field) for field in STATE_FIELDS}
+    
+    @classmethod
+    def from_record(cls, record, requester, **kwargs):
+        return cls(
+            record.get("title") or "Unknown Track",
+            requester,
+            id=record.get("id"),
+            url=record.get("url") or "",
+            webpage_url=record.get("webpage_url") or "",
+            thumbnail=record.get("thumbnail") or "",
+            duration=record.get("duration"),
+            **kwargs
+        )
+    
+    @property
+    def needs_load(self):
+        return self.lazy_load and not self.loaded
+    
+    @property
+    def source_url(self):
+        if self.webpage_url:
+            return self.webpage_url
+        if self.id and not self.url:
+            return f"https://www.youtube.com/watch?v={self.id}"
+        return self.url
+    
+    @property
+    def cache_key(self):
+        return track_cache_key(self.id or extract_video_id(self.source_url) or self.source_url)
+    
+    @property
+    def status_icon(self):
+        if self.preloading:
+            return "🚀"
+        if self.needs_load:
+            return "⏳"
+        return "✅"
+    
+    def apply_record(self, record):
+        for field in TRACK_FIELDS:
+            if record.get(field) is not None:
+                setattr(self, field, record[field])
+        self.loaded = True
+    
+    def copy(self):
+        return copy.copy(self)
+
+class PlaylistCursor:
+    __slots__ = ("url", "requester", "entries", "offset", "base_index", "attached", "streaming")
+    
+    def __init__(self, url, requester, base_index=0, entries=None, streaming=False):
+        self.url = url
+        self.requester = requester
+        self.entries = entries or []
+        self.offset = 0
+        self.base_index = base_index
+        self.attached = False
+        # Пока плейлист догружается, опустевший курсор остается на своем месте в очереди
+        self.streaming = streaming
+    
+    @classmethod
+    def from_state(cls, data):
+        entries = [tuple(entry) for entry in data.get("entries", [])]
+        return cls(data["cursor"], data.get("requester") or "", data.get("base_index", 0), entries)
+    
+    def to_state(self):
+        return {
+            "cursor": self.url,
+            "requester": self.requester,
+            "base_index": self.base_index + self.offset,
+            "entries": self.entries[self.offset:],
+        }
+    
+    def __len__(self):
+        return len(self.entries) - self.offset
+    
+    def add(self, record):
+        video_id = record.get("id")
+        url = record.get("url") or ""
+        if video_id and url == canonical_video_url(video_id):
+            url = ""
+        self.entries.append((video_id, record.get("title") or "Unknown Track", record.get("duration"), url))
+    
+    def take(self, count):
+        chunk = self.entries[self.offset:self.offset + count]
+        start = self.base_index + self.offset
+        self.offset += len(chunk)
+        
+        if self.offset >= 256:
+            del self.entries[:self.offset]
+            self.base_index += self.offset
+            self.offset = 0
+        
+        return [
+            Track(
+                title, self.requester, id=video_id,
+                url=url or (canonical_video_url(video_id) if video_id else ""),
+                duration=duration, playlist_url=self.url, playlist_index=start + i, lazy_load=True
+            )
+            for i, (video_id, title, duration, url) in enumerate(chunk)
+        ]
+    
+    def page(self, start, count):
+        begin = self.offset + start
+        return [("⏳", title, self.requester) for _, title, _, _ in self.entries[begin:begin + count]]
+
+# Длинные плейлисты лежат в очереди курсорами и превращаются в Track окнами по QUEUE_WINDOW
+class GuildQueue:
+    def __init__(self):
+        self.items = deque()
+        self.size = 0
+        self.unresolved = OrderedDict()
+    
+    def __len__(self):
+        return self.size
+    
+    def __iter__(self):
+        return iter(self.items)
+    
+    def append(self, track):
+        self.items.append(track)
+        self.size += 1
+        if track.needs_load:
+            self.unresolved[track] = None
+    
+    def append_cursor(self, cursor):
+        self.items.append(cursor)
+        self.size += len(cursor)
+        cursor.attached = True
+    
+    def extend_cursor(self, cursor, record):
+        if not cursor.attached:
+            return
+        cursor.add(record)
+        self.size += 1
+    
+    def close_cursor(self, cursor):
+        cursor.streaming = False
+        if cursor.attached and not cursor:
+            self.items.remove(cursor)
+            cursor.attached = False
+    
+    def appendleft(self, track):
+        self.items.appendleft(track)
+        self.size += 1
+        if track.needs_load:
+            self.unresolved[track] = None
+            self.unresolved.move_to_end(track, last=False)
+    
+    def _materialize(self, count):
+        index = 0
+        # Пустые курсоры догружающихся плейлистов не считаются позициями очереди
+        skipped = 0
+        while index - skipped < count and index < len(self.items):
+            item = self.items[index]
+            if not isinstance(item, PlaylistCursor):
+                index += 1
+                continue
+            
+            tracks = item.take(max(QUEUE_WINDOW, count - index + skipped))
+            for offset, track in enumerate(tracks):
+                self.items.insert(index + offset, track)
+                self.unresolved[track] = None
+            index += len(tracks)
+            
+            # Курсор остается позади своих треков, новые записи встанут после них
+            if not item:
+                if item.streaming:
+                    index += 1
+                    skipped += 1
+                else:
+                    del self.items[index]
+                    item.attached = False
+    
+    def _tracks(self):
+        return (item for item in self.items if not isinstance(item, PlaylistCursor))
+    
+    def popleft(self):
+        self._materialize(1)
+        track = next(self._tracks())
+        if self.items[0] is track:
+            self.items.popleft()
+        else:
+            self.items.remove(track)
+        self.size -= 1
+        self.unresolved.pop(track, None)
+        return track
+    
+    def peek(self):
+        self._materialize(1)
+        return next(self._tracks(), None)
+    
+    def head(self, count):
+        self._materialize(count)
+        return list(itertools.islice(self._tracks(), count))
+    
+    def page(self, start, count):
+        result = []
+        position = 0
+        for item in self.items:
+            if len(result) >= count:
+                break
+            if isinstance(item, PlaylistCursor):
+                size = len(item)
+                if position + size > start:
+                    offset = max(0, start - position)
+                    result.extend(item.page(offset, count - len(result)))
+                position += size
+            else:
+                if position >= start:
+                    result.append((item.status_icon, item.title, item.requester))
+                position += 1
+        return result
+    
+    def clear(self):
+        for item in self.items:
+            if isinstance(item, PlaylistCursor):
+                item.attached = False
+        self.items.clear()
+        self.size = 0
+        self.unresolved.clear()
+    
+    def _prune_unresolved(self):
+        # Загруженные треки убираем лениво с головы, не копируя весь словарь
+        while self.unresolved:
+            track = next(iter(self.unresolved))
+            if track.needs_load:
+                break
+            del self.unresolved[track]
+    
+    def has_unresolved(self):
+        self._prune_unresolved()
+        return bool(self.unresolved)
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+GAP_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+LOOP_LAG_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.meta = {}
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+    
+    def counter(self, name, help_text):
+        self.meta[name] = ("counter", help_text, None)
+    
+    def histogram(self, name, help_text, buckets):
+        self.meta[name] = ("histogram", help_text, buckets)
+    
+    def gauge(self, name, help_text, func):
+        self.meta[name] = ("gauge", help_text, None)
+        self.gauges[name] = func
+    
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+    
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        buckets = self.meta[name][2]
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * len(buckets), 0.0, 0]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[0][i] += 1
+                    break
+            histogram[1] += value
+            histogram[2] += 1
+    
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = [*labels, *extra]
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+    
+    def render(self):
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: (list(h[0]), h[1], h[2]) for key, h in self.histograms.items()}
+        
+        lines = []
+        for name, (kind, help_text, buckets) in self.meta.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            
+            if kind == "counter":
+                for (metric, labels), value in counters.items():
+                    if metric == name:
+                        lines.append(f"{name}{self._labels(labels)} {value}")
+            elif kind == "histogram":
+                for (metric, labels), (counts, total, count) in histograms.items():
+                    if metric != name:
+                        continue
+                    cumulative = 0
+                    for bound, bucket_count in zip(buckets, counts):
+                        cumulative += bucket_count
+                        lines.append(f"{name}_bucket{self._labels(labels, [('le', bound)])} {cumulative}")
+                    lines.append(f"{name}_bucket{self._labels(labels, [('le', '+Inf')])} {count}")
+                    lines.append(f"{name}_sum{self._labels(labels)} {total:.6f}")
+                    lines.append(f"{name}_count{self._labels(labels)} {count}")
+            else:
+                try:
+                    values = self.gauges[name]()
+                except Exception as e:
+                    logger.warning(f"⚠️ Ошибка метрики {name}: {e}")
+                    continue
+                if not isinstance(values, dict):
+                    values = {(): values}
+                for labels, value in values.items():
+                    lines.append(f"{name}{self._labels(labels)} {value}")
+        
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.histogram("vexel_resolve_seconds", "Время извлечения через yt-dlp без попаданий в кэш", LATENCY_BUCKETS)
+metrics.counter("vexel_cache_requests_total", "Обращения к кэшу по префиксу ключа")
+metrics.histogram("vexel_track_transition_seconds", "Пауза между концом трека и началом следующего", GAP_BUCKETS)
+metrics.histogram("vexel_event_loop_lag_seconds", "Задержка event loop", LOOP_LAG_BUCKETS)
+
+def timed(stage):
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    metrics.observe("vexel_resolve_seconds", time.perf_counter() - start, stage=stage)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    metrics.observe("vexel_resolve_seconds", time.perf_counter() - start, stage=stage)
+        return wrapper
+    return decorator
 
 class CacheManager:
     _instance = None
@@ -54,8 +602,17 @@ class CacheManager:
             return
             
         self.db_path = "/app/cache/bot_cache.db"
-        self.memory_cache = {}
+        self.memory_cache = OrderedDict()
+        self.memory_bytes = 0
+        self.max_entries = CACHE_MEMORY_MAX_ENTRIES
+        self.max_bytes = CACHE_MEMORY_MAX_MB * 1024 * 1024
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "expired": 0}
         self.cache_lock = threading.RLock()
+        self.db_lock = threading.Lock()
+        self.conn = None
+        self.pending_writes = {}
+        self.flush_scheduled = False
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="Cache")
         self.init_db()
         self.initialized = True
     
@@ -63,18 +620,71 @@ class CacheManager:
         try:
             os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
             
-            with sqlite3.connect(self.db_path) as conn:
-                conn.execute('''
-                    CREATE TABLE IF NOT EXISTS track_cache (
-                        key TEXT PRIMARY KEY,
-                        data TEXT,
-                        created_at INTEGER,
-                        expires_at INTEGER
-                    )
-                ''')
-                current_time = int(time.time())
-                conn.execute('DELETE FROM track_cache WHERE expires_at < ?', (current_time,))
-                conn.commit()
+            conn = sqlite3.connect(self.db_path, timeout=10, check_same_thread=False)
+            conn.execute('PRAGMA busy_timeout=10000')
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS track_cache (
+                    key TEXT PRIMARY KEY,
+                    data TEXT,
+                    created_at INTEGER,
+                    expires_at INTEGER
+                )
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS guild_state (
+                    guild_id INTEGER PRIMARY KEY,
+                    voice_channel_id INTEGER,
+                    text_channel_id INTEGER,
+                    current TEXT,
+                    position REAL,
+                    queue TEXT,
+                    history TEXT,
+                    updated_at INTEGER
+                )
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS audio_files (
+                    video_id TEXT PRIMARY KEY,
+                    path TEXT,
+                    acodec TEXT,
+                    size INTEGER,
+                    plays INTEGER,
+                    last_played INTEGER
+                )
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS play_stats (
+                    video_id TEXT,
+                    guild_id INTEGER,
+                    count INTEGER,
+                    last_played INTEGER,
+                    url TEXT,
+                    title TEXT,
+                    PRIMARY KEY (video_id, guild_id)
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_play_stats_last_played ON play_stats (last_played)')
+            conn.execute(
+                'INSERT OR IGNORE INTO play_stats (video_id, guild_id, count, last_played) '
+                'SELECT video_id, 0, plays, last_played FROM audio_files WHERE plays > 0'
+            )
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS shard_stats (
+                    shard_id INTEGER PRIMARY KEY,
+                    pid INTEGER,
+                    guilds INTEGER,
+                    voice_clients INTEGER,
+                    latency_ms INTEGER,
+                    queued_tracks INTEGER,
+                    updated_at INTEGER
+                )
+            ''')
+            current_time = int(time.time())
+            conn.execute('DELETE FROM track_cache WHERE expires_at < ?', (current_time,))
+            conn.commit()
+            self.conn = conn
                 
             logger.info(f"✅ Кэш инициализирован")
             
@@ -82,94 +692,775 @@ class CacheManager:
             logger.warning(f"⚠️ Ошибка инициализации кэша: {e}")
             self.db_path = None
     
-    def get(self, key):
+    @staticmethod
+    def _estimate_size(data):
+        if isinstance(data, (str, bytes)):
+            return 49 + len(data)
+        if isinstance(data, dict):
+            return 64 + sum(
+                CacheManager._estimate_size(k) + CacheManager._estimate_size(v)
+                for k, v in data.items()
+            )
+        if isinstance(data, (list, tuple)):
+            return 56 + sum(CacheManager._estimate_size(v) for v in data)
+        return 28
+    
+    def _put_memory(self, key, data, expires_at):
+        size = self._estimate_size(data)
+        
         with self.cache_lock:
-            if key in self.memory_cache:
-                data, expires_at = self.memory_cache[key]
-                if expires_at > time.time():
-                    return data
-                else:
-                    del self.memory_cache[key]
+            self._drop_memory(key)
+            if size > self.max_bytes:
+                return
             
-            if self.db_path:
-                try:
-                    with sqlite3.connect(self.db_path) as conn:
-                        cursor = conn.execute(
-                            'SELECT data, expires_at FROM track_cache WHERE key = ? AND expires_at > ?',
-                            (key, int(time.time()))
-                        )
-                        row = cursor.fetchone()
-                        if row:
-                            data = json.loads(row[0])
-                            expires_at = row[1]
-                            self.memory_cache[key] = (data, expires_at)
-                            return data
-                except Exception:
-                    pass
+            self.memory_cache[key] = (data, expires_at, size)
+            self.memory_bytes += size
             
+            while (len(self.memory_cache) > self.max_entries
+                   or self.memory_bytes > self.max_bytes):
+                self._evict_one()
+    
+    def _drop_memory(self, key):
+        entry = self.memory_cache.pop(key, None)
+        if entry:
+            self.memory_bytes -= entry[2]
+        return entry
+    
+    def _evict_one(self):
+        _, (_, expires_at, size) = self.memory_cache.popitem(last=False)
+        self.memory_bytes -= size
+        if expires_at <= time.time():
+            self.stats["expired"] += 1
+        else:
+            self.stats["evictions"] += 1
+    
+    def _count(self, key, result):
+        self.stats[result] += 1
+        metrics.inc("vexel_cache_requests_total", prefix=key.split(":", 1)[0], result=result)
+    
+    def _get_memory(self, key):
+        with self.cache_lock:
+            entry = self.memory_cache.get(key)
+            if entry:
+                if entry[1] > time.time():
+                    self.memory_cache.move_to_end(key)
+                    self._count(key, "hits")
+                    return entry[0]
+                self._drop_memory(key)
+                self.stats["expired"] += 1
+            
+            pending = self.pending_writes.get(key)
+            if pending and pending[2] > time.time():
+                self._count(key, "hits")
+                return pending[0]
+            
+            return None
+    
+    def _get_db(self, key):
+        if not self.conn:
             return None
+        
+        try:
+            with self.db_lock:
+                row = self.conn.execute(
+                    'SELECT data, expires_at FROM track_cache WHERE key = ? AND expires_at > ?',
+                    (key, int(time.time()))
+                ).fetchone()
+            if row:
+                raw = row[0]
+                if isinstance(raw, bytes):
+                    raw = zlib.decompress(raw)
+                data = json.loads(raw)
+                self._put_memory(key, data, row[1])
+                with self.cache_lock:
+                    self._count(key, "hits")
+                return data
+        except Exception:
+            pass
+        
+        with self.cache_lock:
+            self._count(key, "misses")
+        return None
+    
+    def _is_deleted(self, key):
+        with self.cache_lock:
+            pending = self.pending_writes.get(key)
+            return pending is not None and pending[0] is None
+    
+    def get(self, key):
+        data = self._get_memory(key)
+        if data is not None:
+            return data
+        if not self.conn or self._is_deleted(key):
+            with self.cache_lock:
+                self._count(key, "misses")
+            return None
+        return self._get_db(key)
+    
+    async def aget(self, key):
+        data = self._get_memory(key)
+        if data is not None:
+            return data
+        if not self.conn or self._is_deleted(key):
+            with self.cache_lock:
+                self._count(key, "misses")
+            return None
+        
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self._get_db, key)
     
     def set(self, key, data, ttl=3600):
-        expires_at = int(time.time()) + ttl
+        created_at = int(time.time())
+        expires_at = created_at + ttl
         
+        self._put_memory(key, data, expires_at)
+        
+        with self.cache_lock:
+            if self.conn:
+                self.pending_writes[key] = (data, created_at, expires_at)
+                if not self.flush_scheduled:
+                    self.flush_scheduled = True
+                    self.executor.submit(self._flush)
+    
+    async def aset(self, key, data, ttl=3600):
+        self.set(key, data, ttl)
+    
+    def delete(self, key):
         with self.cache_lock:
-            self.memory_cache[key] = (data, expires_at)
+            self._drop_memory(key)
             
-            if self.db_path:
-                try:
-                    with sqlite3.connect(self.db_path) as conn:
-                        conn.execute(
-                            'INSERT OR REPLACE INTO track_cache (key, data, created_at, expires_at) VALUES (?, ?, ?, ?)',
-                            (key, json.dumps(data), int(time.time()), expires_at)
-                        )
-                        conn.commit()
-                except Exception:
-                    pass
+            if self.conn:
+                self.pending_writes[key] = (None, 0, 0)
+                if not self.flush_scheduled:
+                    self.flush_scheduled = True
+                    self.executor.submit(self._flush)
+    
+    async def adelete(self, key):
+        self.delete(key)
+    
+    def _flush(self):
+        with self.cache_lock:
+            pending = self.pending_writes
+            self.pending_writes = {}
+            self.flush_scheduled = False
+        
+        if not pending:
+            return
+        
+        try:
+            rows = [
+                (key, zlib.compress(json.dumps(data, separators=(",", ":")).encode(), 1), created_at, expires_at)
+                for key, (data, created_at, expires_at) in pending.items()
+                if data is not None
+            ]
+            deleted = [(key,) for key, (data, _, _) in pending.items() if data is None]
+            with self.db_lock:
+                self.conn.executemany(
+                    'INSERT OR REPLACE INTO track_cache (key, data, created_at, expires_at) VALUES (?, ?, ?, ?)',
+                    rows
+                )
+                self.conn.executemany('DELETE FROM track_cache WHERE key = ?', deleted)
+                self.conn.commit()
+        except Exception as e:
+            logger.warning(f"⚠️ Ошибка записи кэша: {e}")
     
     def cleanup(self):
         current_time = time.time()
         
         with self.cache_lock:
-            expired_keys = [k for k, (_, exp) in self.memory_cache.items() if exp <= current_time]
+            expired_keys = [k for k, (_, exp, _) in self.memory_cache.items() if exp <= current_time]
             for key in expired_keys:
-                del self.memory_cache[key]
+                self._drop_memory(key)
+            self.stats["expired"] += len(expired_keys)
             
-            if self.db_path:
-                try:
-                    with sqlite3.connect(self.db_path) as conn:
-                        conn.execute('DELETE FROM track_cache WHERE expires_at < ?', (int(current_time),))
-                        conn.commit()
-                except Exception:
-                    pass
+        if self.conn:
+            try:
+                with self.db_lock:
+                    self.conn.execute('DELETE FROM track_cache WHERE expires_at < ?', (int(current_time),))
+                    self.conn.commit()
+            except Exception:
+                pass
+    
+    def get_stats(self):
+        with self.cache_lock:
+            return {
+                **self.stats,
+                "entries": len(self.memory_cache),
+                "bytes": self.memory_bytes,
+            }
+    
+    async def acleanup(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self.cleanup)
+    
+    def close(self):
+        self.executor.submit(self._flush)
+        self.executor.shutdown(wait=True)
+        if self.conn:
+            with self.db_lock:
+                self.conn.close()
+            self.conn = None
 
 cache_manager = CacheManager()
 
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NEXT = 1
+PRIORITY_PRELOAD = 2
+
+class AudioFileCache:
+    def __init__(self):
+        self.enabled = AUDIO_CACHE_ENABLED and cache_manager.conn is not None
+        self.directory = AUDIO_CACHE_DIR
+        self.max_bytes = AUDIO_CACHE_MAX_MB * 1024 * 1024
+        self.files = {}
+        self.total_bytes = 0
+        self.downloading = set()
+        self.files_lock = threading.Lock()
+        self.evict_lock = threading.Lock()
+        
+        if self.enabled:
+            self.load_index()
+    
+    def load_index(self):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with cache_manager.db_lock:
+                rows = cache_manager.conn.execute(
+                    'SELECT video_id, path, acodec, size FROM audio_files WHERE path IS NOT NULL'
+                ).fetchall()
+                missing = []
+                for video_id, path, acodec, size in rows:
+                    if os.path.exists(path):
+                        self.files[video_id] = (path, acodec, size or 0)
+                        self.total_bytes += size or 0
+                    else:
+                        missing.append((video_id,))
+                cache_manager.conn.executemany(
+                    'UPDATE audio_files SET path = NULL, size = 0 WHERE video_id = ?', missing
+                )
+                cache_manager.conn.commit()
+            logger.info(f"💾 Аудиокэш: {len(self.files)} файлов, {self.total_bytes // (1024 * 1024)} МБ")
+        except Exception as e:
+            logger.warning(f"⚠️ Ошибка инициализации аудиокэша: {e}")
+            self.enabled = False
+    
+    def lookup(self, video_id):
+        if not self.enabled or not video_id:
+            return None
+        
+        with self.files_lock:
+            entry = self.files.get(video_id)
+        if not entry:
+            return None
+        if not os.path.exists(entry[0]):
+            with self.files_lock:
+                if self.files.pop(video_id, None):
+                    self.total_bytes -= entry[2]
+            return None
+        
+        return {"url": entry[0], "acodec": entry[1], "local": True}
+    
+    async def on_play(self, video_id, url, plays):
+        if not self.enabled:
+            return
+        
+        try:
+            if plays < AUDIO_CACHE_MIN_PLAYS:
+                return
+            with self.files_lock:
+                if video_id in self.files or video_id in self.downloading:
+                    return
+                self.downloading.add(video_id)
+            
+            try:
+                future = ytdl_pool.submit_task(
+                    f"download:{video_id}", self._download, video_id, url, priority=PRIORITY_PRELOAD
+                )
+                await asyncio.wrap_future(future)
+            finally:
+                with self.files_lock:
+                    self.downloading.discard(video_id)
+        except Exception as e:
+            logger.warning(f"⚠️ Ошибка аудиокэша {video_id}: {e}")
+    
+    def _download(self, video_id, url):
+        with cache_manager.db_lock:
+            row = cache_manager.conn.execute(
+                'SELECT path, acodec, size FROM audio_files WHERE video_id = ? AND path IS NOT NULL', (video_id,)
+            ).fetchone()
+        if row and os.path.exists(row[0]):
+            with self.files_lock:
+                self.files[video_id] = (row[0], row[1], row[2] or 0)
+                self.total_bytes += row[2] or 0
+            return
+        
+        opts = get_ytdl_opts()
+        opts["format"] = "bestaudio[acodec=opus]/bestaudio"
+        opts["noplaylist"] = True
+        opts["ignoreerrors"] = False
+        opts["outtmpl"] = os.path.join(self.directory, "%(id)s.%(ext)s")
+        
+        try:
+            info = ytdl_pool.download(opts, url)
+            path = info["path"]
+            size = os.path.getsize(path)
+        except Exception:
+            self._remove_partials(video_id)
+            raise
+        acodec = info["acodec"]
+        
+        with cache_manager.db_lock:
+            cache_manager.conn.execute(
+                'INSERT INTO audio_files (video_id, path, acodec, size, plays, last_played) VALUES (?, ?, ?, ?, 0, ?) '
+                'ON CONFLICT(video_id) DO UPDATE SET path = excluded.path, acodec = excluded.acodec, '
+                'size = excluded.size, last_played = excluded.last_played',
+                (video_id, path, acodec, size, int(time.time()))
+            )
+            cache_manager.conn.commit()
+        
+        with self.files_lock:
+            self.files[video_id] = (path, acodec, size)
+            self.total_bytes += size
+        
+        logger.info(f"💾 Сохранен в аудиокэш: {info['title'] or video_id} ({size // 1024} КБ)")
+        self._evict()
+    
+    def _remove_partials(self, video_id):
+        # Недокачанные .part и промежуточные файлы не учитываются в total_bytes и иначе остались бы навсегда
+        prefix = f"{video_id}."
+        try:
+            with os.scandir(self.directory) as entries:
+                for entry in entries:
+                    if entry.name.startswith(prefix):
+                        os.remove(entry.path)
+        except OSError as e:
+            logger.warning(f"⚠️ Не удалось удалить недокачанный файл {video_id}: {e}")
+    
+    def _evict(self):
+        # Вытеснение идет из потоков пула, параллельные проходы посчитали бы одни файлы дважды
+        with self.evict_lock:
+            self._evict_locked()
+    
+    def _evict_locked(self):
+        if self.total_bytes <= self.max_bytes:
+            return
+        
+        with cache_manager.db_lock:
+            rows = cache_manager.conn.execute(
+                'SELECT video_id, path, size FROM audio_files WHERE path IS NOT NULL ORDER BY last_played'
+            ).fetchall()
+        
+        evicted = []
+        for video_id, path, size in rows:
+            if self.total_bytes <= self.max_bytes:
+                break
+            
+            # Файлы, скачанные другими процессами, не входят в наш total_bytes
+            with self.files_lock:
+                entry = self.files.pop(video_id, None)
+                if not entry:
+                    continue
+                self.total_bytes -= entry[2]
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            evicted.append((video_id,))
+        
+        with cache_manager.db_lock:
+            cache_manager.conn.executemany(
+                'UPDATE audio_files SET path = NULL, size = 0 WHERE video_id = ?', evicted
+            )
+            cache_manager.conn.commit()
+        
+        logger.info(f"🧹 Аудиокэш: удалено {len(evicted)} файлов")
+
+class YTDLPJob:
+    def __init__(self, task_id, func, args, kwargs, priority, guild_id):
+        self.task_id = task_id
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.guild_id = guild_id
+        self.guilds = {guild_id}
+        self.submitted_at = time.monotonic()
+        self.future = Future()
+        self.queued = True
+
+class ThreadExtractionBackend:
+    name = "thread"
+    
+    def __init__(self, ytdl_factory=yt_dlp.YoutubeDL):
+        self.ytdl_factory = ytdl_factory
+        self.local = threading.local()
+        self.cookie_jar = None
+        self.cookie_lock = threading.Lock()
+    
+    def _get_cookie_jar(self, cookies_file):
+        with self.cookie_lock:
+            if self.cookie_jar is None:
+                try:
+                    self.cookie_jar = yt_dlp.cookies.load_cookies(cookies_file, None, None)
+                except Exception as e:
+                    logger.warning(f"⚠️ Ошибка загрузки cookies: {e}")
+                    self.cookie_jar = False
+            return self.cookie_jar
+    
+    def get_ytdl(self, opts):
+        instances = getattr(self.local, "instances", None)
+        if instances is None:
+            instances = self.local.instances = {}
+        
+        key = json.dumps(opts, sort_keys=True, default=str)
+        ytdl = instances.get(key)
+        if ytdl is None:
+            ytdl = self.ytdl_factory(opts)
+            if opts.get("cookiefile"):
+                cookie_jar = self._get_cookie_jar(opts["cookiefile"])
+                if cookie_jar:
+                    ytdl.__dict__["cookiejar"] = cookie_jar
+            instances[key] = ytdl
+        
+        return ytdl
+    
+    def extract_info(self, opts, url):
+        return self.get_ytdl(opts).extract_info(url, download=False)
+    
+    def stream_entries(self, opts, url, limit, on_entry):
+        return workers.stream_entries(self.get_ytdl(opts), url, limit, on_entry)
+    
+    def download(self, opts, url):
+        return workers.download_audio(self.get_ytdl(opts), url)
+    
+    def get_stats(self):
+        return {}
+    
+    def shutdown(self):
+        pass
+
+class ExtractionWorkerError(Exception):
+    pass
+
+class ExtractionWorker:
+    def __init__(self, index):
+        self.index = index
+        self.process = None
+        self.conn = None
+        self.jobs = 0
+        self.lock = threading.Lock()
+    
+    @property
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+    
+    def start(self):
+        parent_sock, child_sock = socket.socketpair()
+        self.process = subprocess.Popen(
+            [sys.executable, workers.__file__, "extract", str(child_sock.fileno())],
+            pass_fds=(child_sock.fileno(),)
+        )
+        child_sock.close()
+        self.conn = Connection(parent_sock.detach())
+        self.jobs = 0
+        logger.info(f"🧪 Воркер извлечения {self.index} запущен (PID {self.process.pid})")
+    
+    def stop(self, graceful=True):
+        if self.process is None:
+            return
+        
+        if graceful and self.alive:
+            try:
+                self.conn.send(("stop",))
+                self.process.wait(timeout=5)
+            except (OSError, ValueError, subprocess.TimeoutExpired):
+                pass
+        if self.alive:
+            self.process.kill()
+            self.process.wait()
+        self.conn.close()
+        self.process = None
+    
+    def restart(self, reason):
+        logger.warning(f"⚠️ Перезапуск воркера извлечения {self.index}: {reason}")
+        self.stop(graceful=False)
+        self.start()
+    
+    def _recv(self, timeout):
+        if not self.conn.poll(timeout):
+            raise ExtractionWorkerError(f"нет ответа за {timeout:.0f}с")
+        try:
+            return self.conn.recv()
+        except (EOFError, OSError) as e:
+            raise ExtractionWorkerError(f"процесс завершился: {e}")
+    
+    def request(self, message, on_entry=None, timeout=EXTRACTION_TIMEOUT):
+        with self.lock:
+            if not self.alive:
+                self.start()
+            elif self.jobs >= EXTRACTION_MAX_JOBS:
+                # Периодический перезапуск освобождает память, накопленную экстракторами
+                logger.info(f"♻️ Воркер извлечения {self.index} обработал {self.jobs} задач, перезапуск")
+                self.stop()
+                self.start()
+            
+            self.jobs += 1
+            try:
+                self.conn.send(message)
+                deadline = time.monotonic() + timeout
+                while True:
+                    reply = self._recv(max(0.0, deadline - time.monotonic()))
+                    if reply[0] == "entry":
+                        on_entry(reply[1])
+                        continue
+                    break
+            except BaseException as e:
+                # Непрочитанные entry/result остались бы в канале и достались бы следующей задаче
+                self.restart(e)
+                if isinstance(e, Exception):
+                    raise yt_dlp.utils.DownloadError(f"Воркер извлечения {self.index}: {e}") from e
+                raise
+        
+        if reply[0] == "error":
+            _, error, expected = reply
+            if expected:
+                # Восстанавливаем expected, чтобы _is_retryable_error не повторял заведомо неудачные запросы
+                cause = yt_dlp.utils.ExtractorError(error, expected=True)
+                raise yt_dlp.utils.DownloadError(error, (type(cause), cause, None))
+            raise yt_dlp.utils.DownloadError(error)
+        return reply[1]
+    
+    def ping(self):
+        # Проверяем только простаивающий воркер, занятый и так под наблюдением таймаута
+        if not self.lock.acquire(blocking=False):
+            return
+        try:
+            if self.process is None:
+                return
+            try:
+                if not self.alive:
+                    raise ExtractionWorkerError("процесс не запущен")
+                self.conn.send(("ping",))
+                self._recv(10)
+            except (ExtractionWorkerError, OSError, ValueError) as e:
+                self.restart(e)
+        finally:
+            self.lock.release()
+
+class ProcessExtractionBackend:
+    name = "process"
+    
+    def __init__(self):
+        self.local = threading.local()
+        self.workers = []
+        self.workers_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.health_thread = None
+    
+    def _worker(self):
+        # Каждый поток пула получает свой процесс с прогретыми экземплярами YoutubeDL
+        worker = getattr(self.local, "worker", None)
+        if worker is None:
+            with self.workers_lock:
+                worker = self.local.worker = ExtractionWorker(len(self.workers))
+                self.workers.append(worker)
+                if self.health_thread is None:
+                    self.health_thread = threading.Thread(target=self._health_loop, name="ExtractionHealth", daemon=True)
+                    self.health_thread.start()
+        return worker
+    
+    def _health_loop(self):
+        while not self.stopped.wait(EXTRACTION_HEALTH_INTERVAL):
+            with self.workers_lock:
+                workers_list = list(self.workers)
+            for worker in workers_list:
+                worker.ping()
+    
+    def extract_info(self, opts, url):
+        return self._worker().request(("extract", opts, url))
+    
+    def stream_entries(self, opts, url, limit, on_entry):
+        return self._worker().request(("entries", opts, url, limit), on_entry=on_entry)
+    
+    def download(self, opts, url):
+        # Скачивание длинного трека идет намного дольше извлечения метаданных
+        return self._worker().request(("download", opts, url), timeout=EXTRACTION_DOWNLOAD_TIMEOUT)
+    
+    def get_stats(self):
+        with self.workers_lock:
+            return {
+                "processes": sum(1 for worker in self.workers if worker.alive),
+                "jobs": sum(worker.jobs for worker in self.workers),
+            }
+    
+    def shutdown(self):
+        self.stopped.set()
+        with self.workers_lock:
+            workers_list = list(self.workers)
+        for worker in workers_list:
+            with worker.lock:
+                worker.stop()
+
+def create_extraction_backend():
+    if EXTRACTION_BACKEND == "process":
+        return ProcessExtractionBackend()
+    if EXTRACTION_BACKEND != "thread":
+        logger.warning(f"⚠️ Неизвестный EXTRACTION_BACKEND={EXTRACTION_BACKEND}, используются потоки")
+    return ThreadExtractionBackend()
+
 class YTDLPPool:
-    def __init__(self, max_workers=6):
-        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="YTDLP")
+    def __init__(self, max_workers=6, backend=None):
+        self.max_workers = max_workers
+        self.backend = backend or ThreadExtractionBackend()
+        self.buckets = [OrderedDict() for _ in range(PRIORITY_PRELOAD + 1)]
         self.active_tasks = {}
         self.task_lock = threading.Lock()
+        self.task_available = threading.Condition(self.task_lock)
+        self.active_workers = 0
+        self.queued_count = 0
+        self.latency = {}
+        self.shutting_down = False
+        self.workers = []
+        for i in range(max_workers):
+            worker = threading.Thread(target=self._worker, name=f"YTDLP_{i}", daemon=True)
+            worker.start()
+            self.workers.append(worker)
+    
+    def extract_info(self, opts, url):
+        return self.backend.extract_info(opts, url)
+    
+    def stream_entries(self, opts, url, limit, on_entry):
+        return self.backend.stream_entries(opts, url, limit, on_entry)
+    
+    def download(self, opts, url):
+        return self.backend.download(opts, url)
     
-    def submit_task(self, task_id, func, *args, **kwargs):
+    def submit_task(self, task_id, func, *args, priority=PRIORITY_INTERACTIVE, guild_id=None, **kwargs):
         with self.task_lock:
-            if task_id in self.active_tasks:
-                return self.active_tasks[task_id]
+            job = self.active_tasks.get(task_id)
+            if job:
+                job.guilds.add(guild_id)
+                if job.queued and priority < job.priority:
+                    self._unqueue(job)
+                    job.priority = priority
+                    self._enqueue(job)
+                return job.future
             
-            future = self.executor.submit(func, *args, **kwargs)
-            self.active_tasks[task_id] = future
+            job = YTDLPJob(task_id, func, args, kwargs, priority, guild_id)
+            self.active_tasks[task_id] = job
+            self._enqueue(job)
+            self.task_available.notify()
+            return job.future
+    
+    def _enqueue(self, job):
+        self.buckets[job.priority].setdefault(job.guild_id, deque()).append(job)
+        self.queued_count += 1
+    
+    def _unqueue(self, job):
+        bucket = self.buckets[job.priority]
+        jobs = bucket[job.guild_id]
+        jobs.remove(job)
+        if not jobs:
+            del bucket[job.guild_id]
+        self.queued_count -= 1
+    
+    def _next_job(self):
+        for bucket in self.buckets:
+            if not bucket:
+                continue
             
-            def cleanup_task(fut):
-                with self.task_lock:
-                    self.active_tasks.pop(task_id, None)
+            guild_id, jobs = next(iter(bucket.items()))
+            job = jobs.popleft()
+            if jobs:
+                bucket.move_to_end(guild_id)
+            else:
+                del bucket[guild_id]
+            self.queued_count -= 1
+            job.queued = False
+            return job
+        return None
+    
+    def _worker(self):
+        while True:
+            with self.task_lock:
+                job = self._next_job()
+                while job is None:
+                    if self.shutting_down:
+                        return
+                    self.task_available.wait()
+                    job = self._next_job()
+                self.active_workers += 1
             
-            future.add_done_callback(cleanup_task)
-            return future
+            try:
+                if job.future.set_running_or_notify_cancel():
+                    try:
+                        job.future.set_result(job.func(*job.args, **job.kwargs))
+                    except BaseException as e:
+                        job.future.set_exception(e)
+            finally:
+                with self.task_lock:
+                    self.active_workers -= 1
+                    if self.active_tasks.get(job.task_id) is job:
+                        del self.active_tasks[job.task_id]
+                    if not job.future.cancelled():
+                        kind = job.task_id.split(":", 1)[0]
+                        samples = self.latency.get(kind)
+                        if samples is None:
+                            samples = self.latency[kind] = deque(maxlen=50)
+                        samples.append(time.monotonic() - job.submitted_at)
+    
+    def cancel_guild(self, guild_id, min_priority=PRIORITY_PRELOAD):
+        cancelled = 0
+        with self.task_lock:
+            for bucket in self.buckets[min_priority:]:
+                for job in bucket.pop(guild_id, ()):
+                    self.queued_count -= 1
+                    job.guilds.discard(guild_id)
+                    if job.guilds:
+                        # Задачу ждут другие гильдии, переносим ее в очередь одной из них
+                        job.guild_id = next(iter(job.guilds))
+                        self._enqueue(job)
+                        continue
+                    job.queued = False
+                    job.future.cancel()
+                    self.active_tasks.pop(job.task_id, None)
+                    cancelled += 1
+        return cancelled
+    
+    def latency_estimate(self, kind, default=3.0, quantile=0.9):
+        with self.task_lock:
+            samples = sorted(self.latency.get(kind, ()))
+        if not samples:
+            return default
+        return samples[min(len(samples) - 1, int(len(samples) * quantile))]
+    
+    def get_stats(self):
+        with self.task_lock:
+            stats = {
+                "workers": self.max_workers,
+                "active": self.active_workers,
+                "queued": self.queued_count,
+                "backend": self.backend.name,
+            }
+        stats.update(self.backend.get_stats())
+        return stats
+    
+    def shutdown(self, wait=True):
+        with self.task_lock:
+            self.shutting_down = True
+            self.task_available.notify_all()
+        if wait:
+            for worker in self.workers:
+                worker.join()
+            self.backend.shutdown()
 
-ytdl_pool = YTDLPPool(max_workers=6)
+ytdl_pool = YTDLPPool(max_workers=YTDLP_WORKERS, backend=create_extraction_backend())
+audio_file_cache = AudioFileCache()
 
 class PreloadManager:
     def __init__(self):
         self.preload_locks = {}
+        self.schedules = {}
     
     def get_preload_lock(self, guild_id):
         if guild_id not in self.preload_locks:
@@ -185,9 +1476,8 @@ class PreloadManager:
                     return
                 
                 tracks_to_preload = []
-                for i, track in enumerate(queue[:count]):
-                    if (track.get("lazy_load") and not track.get("loaded") 
-                        and not track.get("preloading")):
+                for i, track in enumerate(queue.head(count)):
+                    if track.needs_load and not track.preloading:
                         tracks_to_preload.append((i, track))
                 
                 if not tracks_to_preload:
@@ -197,8 +1487,8 @@ class PreloadManager:
                 
                 tasks = []
                 for i, track in tracks_to_preload:
-                    track["preloading"] = True
-                    task = asyncio.create_task(self._preload_single_track(track, i))
+                    track.preloading = True
+                    task = asyncio.create_task(self._preload_single_track(track, i, guild_id))
                     tasks.append(task)
                 
                 results = await asyncio.gather(*tasks, return_exceptions=True)
@@ -209,76 +1499,176 @@ class PreloadManager:
             except Exception as e:
                 logger.error(f"❌ Ошибка предзагрузки: {e}")
     
-    async def _preload_single_track(self, track, index):
-        try:
-            logger.info(f"🚀 Предзагрузка #{index + 1}: {track['title']}")
+    def schedule(self, guild_id):
+        task = self.schedules.pop(guild_id, None)
+        if task:
+            task.cancel()
+        self.schedules[guild_id] = asyncio.create_task(self._run_schedule(guild_id))
+    
+    def forget(self, guild_id):
+        task = self.schedules.pop(guild_id, None)
+        if task:
+            task.cancel()
+        self.preload_locks.pop(guild_id, None)
+    
+    def estimate_resolve(self, track):
+        cost = ytdl_pool.latency_estimate("audio_url")
+        if track.needs_load:
+            cost += ytdl_pool.latency_estimate("metadata")
+        return cost * PRELOAD_SAFETY_FACTOR + PRELOAD_SAFETY_SECONDS
+    
+    def _needs_resolve(self, track, needed_for):
+        if track.needs_load:
+            return True
+        if audio_file_cache.lookup(track.id):
+            return False
+        return track.stream_expires < time.time() + needed_for
+    
+    def _next_due(self, guild_id, failed):
+        current = current_tracks.get(guild_id)
+        source = playing_sources.get(guild_id)
+        
+        # Через сколько секунд начнется очередной трек из очереди
+        starts_in = 0
+        if current and source and current.duration:
+            starts_in = max(0, current.duration - source.position)
+        
+        for i, track in enumerate(get_queue(guild_id).head(PRELOAD_ON_NEXT)):
+            # URL должен быть действителен к началу трека, дальше живой поток продлевает восстановление
+            needed_for = starts_in + PRELOAD_SAFETY_SECONDS
+            if track not in failed and self._needs_resolve(track, needed_for):
+                lead = self.estimate_resolve(track)
+                if track.needs_load and i < PRELOAD_IMMEDIATE:
+                    return track, 0, starts_in, needed_for, lead
+                return track, starts_in - lead, starts_in, needed_for, lead
             
-            cache_key = f"track_full:{track['playlist_url']}:{track['playlist_index']}"
+            if not track.duration:
+                break
+            starts_in += track.duration
+        
+        return None
+    
+    async def _run_schedule(self, guild_id):
+        failed = set()
+        try:
+            while True:
+                due = self._next_due(guild_id, failed)
+                if not due:
+                    return
+                
+                track, wait, starts_in, needed_for, lead = due
+                if wait > 0:
+                    # Позиция сдвигается на паузе и при перемотке, поэтому план пересчитывается
+                    await asyncio.sleep(min(wait, 5))
+                    continue
+                
+                priority = PRIORITY_NEXT if starts_in < lead / 2 else PRIORITY_PRELOAD
+                if not await self.resolve_ahead(track, guild_id, needed_for, priority):
+                    failed.add(track)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"❌ Ошибка планировщика предзагрузки: {e}")
+        finally:
+            if self.schedules.get(guild_id) is asyncio.current_task():
+                del self.schedules[guild_id]
+    
+    async def resolve_ahead(self, track, guild_id, needed_for, priority):
+        try:
+            if track.needs_load:
+                track.preloading = True
+                try:
+                    return await self.load_track(track, priority, guild_id)
+                finally:
+                    track.preloading = False
             
-            cached_data = cache_manager.get(cache_key)
-            if cached_data:
-                logger.info(f"📦 Трек уже в кэше: {track['title']}")
-                track.update(cached_data)
-                track["loaded"] = True
-                track["preloading"] = False
-                return True
+            cache_key = audio_url_cache_key(track.source_url)
+            cached = valid_record(await cache_manager.aget(cache_key))
+            if cached:
+                expires_in = stream_url_ttl(cached["url"])
+                if expires_in >= needed_for:
+                    track.stream_expires = time.time() + expires_in
+                    return True
+                logger.info(f"⌛ URL истечет до начала трека, обновляем: {track.title}")
+                await cache_manager.adelete(cache_key)
             
-            full_info = await self._load_track_metadata(
-                track["playlist_url"], 
-                track["playlist_index"]
-            )
+            audio = await get_audio_url(track.source_url, track.title, priority=priority, guild_id=guild_id)
+            expires_in = stream_url_ttl(audio["url"])
+            track.stream_expires = time.time() + expires_in
+            if expires_in < needed_for:
+                # Повторное извлечение не даст URL дольше, планировщик больше не трогает этот трек
+                logger.info(f"⌛ Свежий URL живет {expires_in:.0f}с, меньше нужных {needed_for:.0f}с: {track.title}")
+                return False
+            logger.info(f"🚀 Поток готов заранее: {track.title}")
+            return True
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось подготовить {track.title}: {e}")
+            return False
+    
+    async def _preload_single_track(self, track, index, guild_id):
+        try:
+            logger.info(f"🚀 Предзагрузка #{index + 1}: {track.title}")
             
-            if full_info:
-                cache_manager.set(cache_key, full_info, ttl=3600)
-                
-                track.update(full_info)
-                track["loaded"] = True
-                logger.info(f"✅ Предзагружен: {track['title']}")
+            if await self.load_track(track, PRIORITY_PRELOAD, guild_id):
+                logger.info(f"✅ Предзагружен: {track.title}")
                 return True
             
             return False
             
         except Exception as e:
-            logger.error(f"❌ Ошибка предзагрузки {track['title']}: {e}")
+            logger.error(f"❌ Ошибка предзагрузки {track.title}: {e}")
             return False
         finally:
-            track["preloading"] = False
+            track.preloading = False
     
-    async def _load_track_metadata(self, playlist_url, index):
+    async def load_track(self, track, priority=PRIORITY_NEXT, guild_id=None):
+        cache_key = track.cache_key
+        
+        cached_data = valid_record(await cache_manager.aget(cache_key))
+        if cached_data:
+            track.apply_record(cached_data)
+            return True
+        
+        full_info = await self._load_track_metadata(
+            track.source_url, cache_key, priority, guild_id
+        )
+        
+        if full_info:
+            track.apply_record(full_info)
+            await cache_manager.aset(track.cache_key, full_info, ttl=3600)
+            return True
+        
+        return False
+    
+    async def _load_track_metadata(self, video_url, cache_key, priority=PRIORITY_NEXT, guild_id=None):
         try:
-            task_id = f"metadata:{playlist_url}:{index}"
+            task_id = f"metadata:{cache_key}"
             future = ytdl_pool.submit_task(
                 task_id, 
                 self._extract_track_metadata, 
-                playlist_url, 
-                index
+                video_url,
+                priority=priority,
+                guild_id=guild_id
             )
             
             return await asyncio.wrap_future(future)
             
         except Exception as e:
-            logger.error(f"❌ Ошибка загрузки метаданных трека {index}: {e}")
+            logger.error(f"❌ Ошибка загрузки метаданных {video_url}: {e}")
             return None
     
-    def _extract_track_metadata(self, playlist_url, index):
+    @timed("track_metadata")
+    def _extract_track_metadata(self, video_url):
         try:
             opts = get_ytdl_opts(extract_flat=False)
             opts["skip_download"] = True
             opts["quiet"] = True
-            opts["playliststart"] = index + 1
-            opts["playlistend"] = index + 1
+            opts["noplaylist"] = True
             
-            ytdl_temp = yt_dlp.YoutubeDL(opts)
-            info = ytdl_temp.extract_info(playlist_url, download=False)
+            info = ytdl_pool.extract_info(opts, video_url)
             
-            if info and "entries" in info and len(info["entries"]) > 0:
-                entry = info["entries"][0]
-                return {
-                    "url": entry.get("url", ""),
-                    "webpage_url": entry.get("webpage_url", ""),
-                    "thumbnail": entry.get("thumbnail", ""),
-                    "title": entry.get("title", "Unknown Track")
-                }
+            if info:
+                return make_track_record(info)
         except Exception as e:
             logger.error(f"❌ Ошибка извлечения метаданных: {e}")
         
@@ -286,6 +1676,134 @@ class PreloadManager:
 
 preload_manager = PreloadManager()
 
+class PlayStats:
+    def __init__(self):
+        self.warming = False
+        self.stats = {"runs": 0, "tracks": 0, "refreshed": 0}
+        self.tasks = set()
+    
+    def record(self, track, guild_id):
+        if cache_manager.conn and track.id:
+            # Event loop хранит только слабые ссылки на задачи
+            task = asyncio.create_task(self._record(track, guild_id))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+    
+    async def _record(self, track, guild_id):
+        try:
+            loop = asyncio.get_running_loop()
+            plays = await loop.run_in_executor(
+                cache_manager.executor, self._increment, track.id, guild_id, track.source_url, track.title
+            )
+            await audio_file_cache.on_play(track.id, track.source_url, plays)
+        except Exception as e:
+            logger.warning(f"⚠️ Ошибка статистики прослушиваний: {e}")
+    
+    def _increment(self, video_id, guild_id, url, title):
+        now = int(time.time())
+        with cache_manager.db_lock:
+            cache_manager.conn.execute(
+                'INSERT INTO play_stats (video_id, guild_id, count, last_played, url, title) VALUES (?, ?, 1, ?, ?, ?) '
+                'ON CONFLICT(video_id, guild_id) DO UPDATE SET count = count + 1, '
+                'last_played = excluded.last_played, url = excluded.url, title = excluded.title',
+                (video_id, guild_id, now, url, title)
+            )
+            cache_manager.conn.execute(
+                'UPDATE audio_files SET last_played = ? WHERE video_id = ?', (now, video_id)
+            )
+            cache_manager.conn.commit()
+            row = cache_manager.conn.execute(
+                'SELECT SUM(count) FROM play_stats WHERE video_id = ?', (video_id,)
+            ).fetchone()
+        return row[0] or 0
+    
+    def top(self, limit):
+        since = int(time.time()) - CACHE_WARMUP_DAYS * 86400
+        query = (
+            'SELECT video_id, url, title, SUM(count) AS total, MAX(last_played) '
+            'FROM play_stats WHERE last_played > ?'
+        )
+        params = [since]
+        
+        # В шардированном режиме каждый процесс прогревает треки своих гильдий
+        shard_ids = getattr(bot, "shard_ids", None)
+        if bot.shard_count and shard_ids is not None:
+            query += f' AND (guild_id >> 22) % ? IN ({", ".join("?" * len(shard_ids))})'
+            params += [bot.shard_count, *shard_ids]
+        
+        # url и title берутся из строки с MAX(last_played)
+        query += ' GROUP BY video_id ORDER BY total DESC LIMIT ?'
+        params.append(limit)
+        
+        with cache_manager.db_lock:
+            rows = cache_manager.conn.execute(query, params).fetchall()
+        return [(video_id, url, title) for video_id, url, title, _, _ in rows]
+    
+    def pool_idle(self):
+        stats = ytdl_pool.get_stats()
+        return stats["queued"] == 0 and stats["active"] < max(1, stats["workers"] // 2)
+    
+    async def warm_up(self):
+        if self.warming or not cache_manager.conn:
+            return
+        
+        self.warming = True
+        try:
+            loop = asyncio.get_running_loop()
+            top = await loop.run_in_executor(cache_manager.executor, self.top, CACHE_WARMUP_TOP)
+            if not top:
+                return
+            
+            logger.info(f"🔥 Прогрев кэша: {len(top)} популярных треков")
+            semaphore = asyncio.Semaphore(CACHE_WARMUP_CONCURRENCY)
+            refreshed = await asyncio.gather(*(self._warm_track(semaphore, *entry) for entry in top))
+            
+            self.stats["runs"] += 1
+            self.stats["tracks"] += len(top)
+            self.stats["refreshed"] += sum(refreshed)
+            logger.info(f"🔥 Прогрев завершен: обновлено {sum(refreshed)} из {len(top)}")
+        except Exception as e:
+            logger.error(f"❌ Ошибка прогрева кэша: {e}")
+        finally:
+            self.warming = False
+    
+    async def _warm_track(self, semaphore, video_id, url, title):
+        async with semaphore:
+            # Прогрев не должен отнимать потоки yt-dlp у пользователей
+            while not self.pool_idle():
+                await asyncio.sleep(5)
+            
+            track = Track(title or video_id, "", id=video_id, url=url or canonical_video_url(video_id), lazy_load=True)
+            refreshed = False
+            
+            cached = valid_record(await cache_manager.aget(track.cache_key))
+            if cached:
+                track.apply_record(cached)
+            else:
+                refreshed = True
+                if not await preload_manager.resolve_ahead(track, None, 0, PRIORITY_PRELOAD):
+                    return False
+            
+            if audio_file_cache.lookup(video_id):
+                return refreshed
+            
+            cached_audio = valid_record(await cache_manager.aget(audio_url_cache_key(track.source_url)))
+            if cached_audio and stream_url_ttl(cached_audio["url"]) >= CACHE_WARMUP_INTERVAL:
+                return refreshed
+            
+            await preload_manager.resolve_ahead(track, None, CACHE_WARMUP_INTERVAL, PRIORITY_PRELOAD)
+            return True
+    
+    async def warm_up_periodic(self):
+        while True:
+            try:
+                await self.warm_up()
+            except Exception as e:
+                logger.error(f"❌ Ошибка прогрева кэша: {e}")
+            await asyncio.sleep(CACHE_WARMUP_INTERVAL)
+
+play_stats = PlayStats()
+
 def get_ytdl_opts(extract_flat=False):
     ytdl_opts = {
         "format": "bestaudio[ext=m4a]/bestaudio[ext=mp3]/bestaudio/best",
@@ -306,42 +1824,435 @@ def get_ytdl_opts(extract_flat=False):
         "fragment_retries": 3,
     }
     
-    cookies_file = os.getenv("YOUTUBE_COOKIES_FILE")
-    if cookies_file and os.path.exists(cookies_file):
+    cookies_file = get_cookies_file()
+    if cookies_file:
         ytdl_opts["cookiefile"] = cookies_file
     
     return ytdl_opts
 
+@functools.lru_cache(maxsize=1)
+def get_cookies_file():
+    cookies_file = os.getenv("YOUTUBE_COOKIES_FILE")
+    if cookies_file and os.path.exists(cookies_file):
+        return cookies_file
+    return None
+
+def owns_guild(guild_id):
+    if not bot.shard_count:
+        return True
+    shard_ids = bot.shard_ids if getattr(bot, "shard_ids", None) is not None else range(bot.shard_count)
+    return (guild_id >> 22) % bot.shard_count in shard_ids
+
+def collect_shard_stats():
+    latencies = getattr(bot, "latencies", None) or [(0, bot.latency)]
+    stats = {
+        shard_id: {"guilds": 0, "voice_clients": 0, "queued_tracks": 0, "latency": latency}
+        for shard_id, latency in latencies
+    }
+    
+    for guild in bot.guilds:
+        shard = stats.setdefault(guild.shard_id, {"guilds": 0, "voice_clients": 0, "queued_tracks": 0, "latency": 0})
+        shard["guilds"] += 1
+        shard["queued_tracks"] += len(queues.get(guild.id) or ())
+    
+    for vc in bot.voice_clients:
+        if vc.guild.shard_id in stats:
+            stats[vc.guild.shard_id]["voice_clients"] += 1
+    
+    return stats
+
+def shard_stats_rows():
+    now = int(time.time())
+    return [
+        (
+            shard_id, os.getpid(), shard["guilds"], shard["voice_clients"],
+            # До первого heartbeat задержка равна NaN
+            int(shard["latency"] * 1000) if shard["latency"] == shard["latency"] else -1,
+            shard["queued_tracks"], now
+        )
+        for shard_id, shard in collect_shard_stats().items()
+    ]
+
+def _write_shard_stats(rows):
+    with cache_manager.db_lock:
+        cache_manager.conn.executemany(
+            'INSERT OR REPLACE INTO shard_stats VALUES (?, ?, ?, ?, ?, ?, ?)', rows
+        )
+        # Строки завершившихся процессов больше не обновляются
+        cache_manager.conn.execute(
+            'DELETE FROM shard_stats WHERE updated_at < ?', (int(time.time()) - SHARD_STATS_INTERVAL * 10,)
+        )
+        cache_manager.conn.commit()
+
+def _read_shard_stats():
+    with cache_manager.db_lock:
+        return cache_manager.conn.execute(
+            'SELECT shard_id, pid, guilds, voice_clients, latency_ms, queued_tracks, updated_at '
+            'FROM shard_stats ORDER BY shard_id'
+        ).fetchall()
+
+async def publish_shard_stats_periodic():
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            if cache_manager.conn:
+                await loop.run_in_executor(cache_manager.executor, _write_shard_stats, shard_stats_rows())
+        except Exception as e:
+            logger.error(f"❌ Ошибка статистики шардов: {e}")
+        await asyncio.sleep(SHARD_STATS_INTERVAL)
+
 def log_command(user, command):
     logger.info(f"{user} использовал {command}")
 
 def get_queue(guild_id):
-    return queues.setdefault(guild_id, [])
+    queue = queues.get(guild_id)
+    if queue is None:
+        queue = queues[guild_id] = GuildQueue()
+    return queue
 
 def get_history(guild_id):
-    return track_history.setdefault(guild_id, [])
+    history = track_history.get(guild_id)
+    if history is None:
+        history = track_history[guild_id] = deque(maxlen=20)
+    return history
 
 def add_to_history(guild_id, track):
-    history = get_history(guild_id)
-    history_track = track.copy()
-    history.append(history_track)
-    if len(history) > 20:
-        history.pop(0)
+    get_history(guild_id).append(track.copy())
 
 def get_play_lock(guild_id):
     if guild_id not in play_next_locks:
         play_next_locks[guild_id] = asyncio.Lock()
     return play_next_locks[guild_id]
 
-def create_source(url):
-    return discord.FFmpegPCMAudio(
-        url,
-        before_options=(
-            "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5 "
-            "-reconnect_at_eof 1 -multiple_requests 1 -rw_timeout 10000000"
-        ),
-        options='-vn -bufsize 512k'
-    )
+FFMPEG_BEFORE_OPTIONS = (
+    "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5 "
+    "-reconnect_at_eof 1 -multiple_requests 1 -rw_timeout 10000000"
+)
+
+class PlaybackSource(discord.AudioSource):
+    def __init__(self, source, start=0):
+        self.source = source
+        self.start = start
+        self.frames = 0
+        self.ended = False
+    
+    @property
+    def position(self):
+        return self.start + self.frames * 0.02
+    
+    def read(self):
+        data = self.source.read()
+        if data:
+            self.frames += 1
+        else:
+            self.ended = True
+        return data
+    
+    def is_opus(self):
+        return self.source.is_opus()
+    
+    def cleanup(self):
+        self.source.cleanup()
+
+class WorkerAudioSource(discord.AudioSource):
+    def __init__(self, worker, stream_id):
+        self.worker = worker
+        self.stream_id = stream_id
+        self.frames = deque()
+        self.frames_ready = threading.Condition()
+        self.finished = False
+        self.error = None
+        self.consumed = 0
+        self.closed = False
+    
+    def feed(self, batch):
+        with self.frames_ready:
+            self.frames.extend(batch)
+            self.frames_ready.notify()
+    
+    def finish(self, error=None):
+        with self.frames_ready:
+            self.finished = True
+            self.error = error
+            self.frames_ready.notify()
+    
+    def read(self):
+        with self.frames_ready:
+            if not self.frames and not self.finished:
+                if self.consumed:
+                    audio_workers.underruns += 1
+                self.frames_ready.wait_for(lambda: self.frames or self.finished, AUDIO_WORKER_READ_TIMEOUT)
+            if not self.frames:
+                if self.error:
+                    logger.warning(f"⚠️ Аудиоворкер: {self.error}")
+                    self.error = None
+                return b""
+            data = self.frames.popleft()
+        
+        self.consumed += 1
+        if self.consumed % workers.BATCH_FRAMES == 0:
+            self.worker.send(("credit", self.stream_id, workers.BATCH_FRAMES))
+        return data
+    
+    def is_opus(self):
+        return True
+    
+    def cleanup(self):
+        if not self.closed:
+            self.closed = True
+            self.worker.close_stream(self.stream_id)
+
+class AudioWorker:
+    def __init__(self, index):
+        self.index = index
+        self.process = None
+        self.conn = None
+        self.send_lock = threading.Lock()
+        self.sources = {}
+    
+    @property
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+    
+    def start(self):
+        parent_sock, child_sock = socket.socketpair()
+        self.process = subprocess.Popen(
+            [sys.executable, workers.__file__, "audio", str(child_sock.fileno()), str(AUDIO_WORKER_BUFFER_FRAMES)],
+            pass_fds=(child_sock.fileno(),)
+        )
+        child_sock.close()
+        self.conn = Connection(parent_sock.detach())
+        # У каждого процесса свой словарь потоков, чтобы завершение старого не задело новые
+        self.sources = {}
+        threading.Thread(
+            target=self._read_loop, args=(self.conn, self.sources), name=f"AudioWorker_{self.index}", daemon=True
+        ).start()
+        logger.info(f"🎛️ Аудиоворкер {self.index} запущен (PID {self.process.pid})")
+    
+    def _read_loop(self, conn, sources):
+        while True:
+            try:
+                kind, stream_id, payload = conn.recv()
+            except (EOFError, OSError):
+                break
+            
+            source = sources.get(stream_id)
+            if kind == "end":
+                sources.pop(stream_id, None)
+            if not source:
+                continue
+            if kind == "frames":
+                source.feed(payload)
+            elif kind == "end":
+                source.finish(payload)
+        
+        for source in list(sources.values()):
+            source.finish("аудиоворкер завершился")
+        sources.clear()
+        if not audio_workers.shutting_down:
+            logger.warning(f"⚠️ Аудиоворкер {self.index} завершился")
+    
+    def send(self, message):
+        with self.send_lock:
+            try:
+                self.conn.send(message)
+            except (OSError, ValueError):
+                pass
+    
+    def open_stream(self, stream_id, url, codec, before_options):
+        if not self.alive:
+            self.start()
+        
+        source = WorkerAudioSource(self, stream_id)
+        self.sources[stream_id] = source
+        self.send(("open", stream_id, url, codec, before_options, OPUS_PASSTHROUGH))
+        return source
+    
+    def close_stream(self, stream_id):
+        self.sources.pop(stream_id, None)
+        self.send(("close", stream_id))
+    
+    def stop(self):
+        if self.alive:
+            self.send(("stop", 0))
+            try:
+                self.process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+class AudioWorkerPool:
+    def __init__(self, size):
+        self.workers = [AudioWorker(i) for i in range(size)]
+        self.stream_ids = itertools.count()
+        self.lock = threading.Lock()
+        self.underruns = 0
+        self.shutting_down = False
+    
+    @property
+    def enabled(self):
+        return bool(self.workers)
+    
+    def open(self, url, codec, before_options):
+        with self.lock:
+            worker = min(self.workers, key=lambda w: len(w.sources))
+            return worker.open_stream(next(self.stream_ids), url, codec, before_options)
+    
+    def get_stats(self):
+        return {
+            "workers": sum(1 for w in self.workers if w.alive),
+            "streams": sum(len(w.sources) for w in self.workers),
+            "underruns": self.underruns,
+        }
+    
+    def shutdown(self):
+        self.shutting_down = True
+        for worker in self.workers:
+            worker.stop()
+
+audio_workers = AudioWorkerPool(AUDIO_WORKERS)
+
+def create_source(url, codec=None, start=0, local=False):
+    before_options = "" if local else FFMPEG_BEFORE_OPTIONS
+    if start:
+        before_options = f"-ss {start:.2f} {before_options}"
+    
+    if audio_workers.enabled:
+        source = audio_workers.open(url, codec, before_options)
+    else:
+        source = workers.open_source(url, codec, before_options, OPUS_PASSTHROUGH)
+    
+    return PlaybackSource(source, start)
+
+def stream_url_ttl(url):
+    expire = urllib.parse.parse_qs(urllib.parse.urlparse(url).query).get("expire", [None])[0]
+    if not expire:
+        match = re.search(r"/expire/(\d+)", url)
+        expire = match.group(1) if match else None
+    
+    if not expire or not expire.isdigit():
+        return AUDIO_URL_DEFAULT_TTL
+    
+    return int(expire) - int(time.time()) - AUDIO_URL_EXPIRY_MARGIN
+
+def stream_failed(track, source):
+    if not source.ended or track.stream_retries >= STREAM_MAX_RETRIES:
+        return False
+    
+    duration = track.duration
+    return source.frames == 0 or bool(duration and source.position < duration - 5)
+
+def start_playback(vc, guild_id, track, source):
+    def after_play(error):
+        if error:
+            logger.error(f"❌ Ошибка воспроизведения: {error}")
+        
+        if stream_failed(track, source):
+            transition_starts[guild_id] = (time.perf_counter(), "recover")
+            bot.loop.create_task(recover_stream_safe(vc, guild_id, track, source.position))
+        else:
+            transition_starts[guild_id] = (time.perf_counter(), "next")
+            bot.loop.create_task(play_next_safe(vc, guild_id))
+    
+    transition = transition_starts.pop(guild_id, None)
+    playing_sources[guild_id] = source
+    vc.play(source, after=after_play)
+    if transition:
+        metrics.observe(
+            "vexel_track_transition_seconds", time.perf_counter() - transition[0],
+            reason=transition[1]
+        )
+
+async def recover_stream(vc, guild_id, track, position):
+    lock = get_play_lock(guild_id)
+    async with lock:
+        if current_tracks.get(guild_id) is not track or not vc or not vc.is_connected():
+            return True
+        
+        track.stream_retries += 1
+        track_url = track.source_url
+        logger.warning(f"🔁 Поток оборвался на {position:.0f}с, получаем новый URL: {track.title}")
+        
+        try:
+            await cache_manager.adelete(audio_url_cache_key(track_url))
+            audio = await get_audio_url(track_url, track.title, guild_id=guild_id)
+            source = create_source(audio["url"], audio.get("acodec"), start=position)
+            start_playback(vc, guild_id, track, source)
+            schedule_staging(guild_id, track, position)
+            return True
+        except Exception as e:
+            logger.error(f"❌ Не удалось восстановить поток: {e}")
+            return False
+
+async def recover_stream_safe(vc, guild_id, track, position):
+    try:
+        if not await recover_stream(vc, guild_id, track, position):
+            await play_next(vc, guild_id)
+    except Exception as e:
+        logger.error(f"❌ Ошибка в recover_stream_safe: {e}")
+
+def take_staged_source(guild_id, track):
+    staged = staged_sources.pop(guild_id, None)
+    if not staged:
+        return None
+    
+    staged_track, source = staged
+    if staged_track is track:
+        return source
+    
+    source.cleanup()
+    return None
+
+def discard_staging(guild_id):
+    task = staging_tasks.pop(guild_id, None)
+    if task:
+        task.cancel()
+    
+    staged = staged_sources.pop(guild_id, None)
+    if staged:
+        staged[1].cleanup()
+
+def schedule_staging(guild_id, track, position=0):
+    discard_staging(guild_id)
+    
+    if not GAPLESS_PLAYBACK or not track.duration:
+        return
+    
+    delay = max(0, track.duration - position - GAPLESS_LEAD_SECONDS)
+    staging_tasks[guild_id] = asyncio.create_task(stage_next_source(guild_id, delay))
+
+async def stage_next_source(guild_id, delay):
+    try:
+        await asyncio.sleep(delay)
+        
+        track = get_queue(guild_id).peek()
+        if not track:
+            return
+        
+        if track.needs_load:
+            if not await preload_manager.load_track(track, PRIORITY_NEXT, guild_id):
+                return
+        
+        if not track.source_url:
+            return
+        
+        stream = await resolve_stream(track, guild_id)
+        
+        if get_queue(guild_id).peek() is not track:
+            return
+        
+        staged = staged_sources.pop(guild_id, None)
+        if staged:
+            staged[1].cleanup()
+        staged_sources[guild_id] = (track, create_source(stream["url"], stream["acodec"], local=stream["local"]))
+        logger.info(f"🎚️ Подготовлен следующий: {track.title}")
+        
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.warning(f"⚠️ Ошибка подготовки следующего трека: {e}")
+    finally:
+        if staging_tasks.get(guild_id) is asyncio.current_task():
+            staging_tasks.pop(guild_id, None)
 
 def clean_search_query(query):
     cleaned = re.sub(r'[^\w\s\-.,!?]', '', query)
@@ -387,100 +2298,235 @@ async def safe_voice_disconnect(vc, guild_id):
 
 async def cleanup_guild_data(guild_id):
     try:
+        player_renderer.forget(guild_id)
         await delete_old_player(guild_id)  # <--- теперь всегда удаляем плеер при выходе
         player_channels.pop(guild_id, None)
         current_tracks.pop(guild_id, None)
         queues.pop(guild_id, None)
+        discard_staging(guild_id)
+        transition_starts.pop(guild_id, None)
+        playing_sources.pop(guild_id, None)
+        cancelled = ytdl_pool.cancel_guild(guild_id)
+        if cancelled:
+            logger.info(f"🚫 Отменено {cancelled} задач предзагрузки")
         play_next_locks.pop(guild_id, None)
-        preload_manager.preload_locks.pop(guild_id, None)
+        preload_manager.forget(guild_id)
+        state_store.forget(guild_id)
         logger.info(f"🧹 Данные очищены")
     except Exception as e:
         logger.error(f"❌ Ошибка очистки: {e}")
 
-async def get_audio_url(track_url, title="Unknown", use_cache=True):
-    cache_key = f"audio_url:{track_url}"
+async def resolve_stream(track, guild_id=None):
+    local = audio_file_cache.lookup(track.id)
+    if local:
+        return local
+    
+    audio = await get_audio_url(track.source_url, track.title, guild_id=guild_id)
+    return {"url": audio["url"], "acodec": audio.get("acodec"), "local": False}
+
+async def get_audio_url(track_url, title="Unknown", use_cache=True, priority=PRIORITY_NEXT, guild_id=None):
+    cache_key = audio_url_cache_key(track_url)
+    
+    if use_cache:
+        cached = valid_record(await cache_manager.aget(cache_key))
+        if cached:
+            return cached
+    
+    opts = get_ytdl_opts()
+    opts["format"] = "bestaudio/best"
+    opts["ignoreerrors"] = False
+    task_id = cache_key
+    
+    attempts = 1 + AUDIO_URL_RETRIES
+    for attempt in range(attempts):
+        try:
+            future = ytdl_pool.submit_task(
+                task_id, _extract_audio_url, opts, track_url, priority=priority, guild_id=guild_id
+            )
+            
+            audio = await asyncio.wrap_future(future)
+            
+            if audio:
+                ttl = stream_url_ttl(audio["url"])
+                if use_cache and ttl > 0:
+                    await cache_manager.aset(cache_key, audio, ttl=ttl)
+                return audio
+            break
+            
+        except Exception as e:
+            logger.warning(f"⚠️ Попытка {attempt + 1} получить аудио для {title}: {e}")
+            if not _is_retryable_error(e) or attempt + 1 >= attempts:
+                break
+            await asyncio.sleep(attempt + 1)
+    
+    raise Exception(f"Не удалось получить аудио URL для {title}")
+
+def _is_audio_only(fmt):
+    return fmt.get("vcodec") == "none" and fmt.get("acodec") not in (None, "none")
+
+def _has_audio(fmt):
+    return fmt.get("acodec") not in (None, "none")
+
+AUDIO_FORMAT_PREFERENCES = [
+    lambda f: OPUS_PASSTHROUGH and _is_audio_only(f) and f.get("acodec") == "opus",
+    lambda f: _is_audio_only(f) and f.get("ext") == "m4a",
+    lambda f: _is_audio_only(f) and f.get("ext") == "mp3",
+    _is_audio_only,
+    lambda f: _has_audio(f) and (f.get("height") or 0) <= 720,
+    lambda f: _has_audio(f) and (f.get("height") or 0) <= 480,
+]
+
+def pick_audio_format(info):
+    formats = [f for f in info.get("formats") or () if f.get("url")]
+    
+    # yt-dlp сортирует форматы от худшего к лучшему
+    for matches in AUDIO_FORMAT_PREFERENCES:
+        for fmt in reversed(formats):
+            if matches(fmt):
+                return fmt
+    
+    # Без сведений о кодеках доверяем выбору yt-dlp по "bestaudio/best"
+    if info.get("url"):
+        return info
+    return formats[-1] if formats else None
+
+def _is_retryable_error(error):
+    cause = getattr(error, "exc_info", None)
+    cause = cause[1] if cause else error
+    return not (isinstance(cause, yt_dlp.utils.ExtractorError) and cause.expected)
+
+@timed("audio_url")
+def _extract_audio_url(opts, track_url):
+    info = ytdl_pool.extract_info(opts, track_url)
+    if not info:
+        return None
+    
+    fmt = pick_audio_format(info)
+    if not fmt:
+        return None
+    
+    return {"v": TRACK_RECORD_VERSION, "url": fmt["url"], "acodec": fmt.get("acodec")}
+
+def is_playlist_query(search_query):
+    return "list=" in search_query or "playlist" in search_query.lower()
+
+class PlaylistStream:
+    def __init__(self, loop):
+        self.loop = loop
+        self.lock = threading.Lock()
+        self.records = []
+        self.listeners = []
+        self.future = None
+    
+    def publish(self, record):
+        with self.lock:
+            self.records.append(record)
+            listeners = list(self.listeners)
+        for listener in listeners:
+            self.loop.call_soon_threadsafe(listener.put_nowait, record)
+    
+    def close(self, future):
+        with self.lock:
+            listeners = list(self.listeners)
+        for listener in listeners:
+            self.loop.call_soon_threadsafe(listener.put_nowait, None)
+    
+    def subscribe(self):
+        listener = asyncio.Queue()
+        with self.lock:
+            for record in self.records:
+                listener.put_nowait(record)
+            self.listeners.append(listener)
+        if self.future.done():
+            listener.put_nowait(None)
+        return listener
+    
+    def unsubscribe(self, listener):
+        with self.lock:
+            if listener in self.listeners:
+                self.listeners.remove(listener)
+
+playlist_streams = {}
+
+def _stream_playlist_entries(stream, search_query):
+    # Извлекаем плейлист целиком, без лимита первого слушателя: результат общий и кэшируется для всех гильдий
+    opts = get_ytdl_opts(extract_flat=True)
+    opts["playlistend"] = MAX_PLAYLIST_SIZE
     
-    if use_cache:
-        cached_url = cache_manager.get(cache_key)
-        if cached_url:
-            return cached_url
-    
-    formats_to_try = [
-        "bestaudio[ext=m4a]/bestaudio[ext=mp3]/bestaudio",
-        "bestaudio/best[height<=720]",
-        "best[height<=480]",
-        "worst"
-    ]
+    def publish(entry):
+        if entry.get("title"):
+            stream.publish(make_track_record(entry))
     
-    for format_selector in formats_to_try:
-        try:
-            opts = get_ytdl_opts()
-            opts["format"] = format_selector
-            
-            task_id = f"audio_url:{track_url}:{format_selector}"
-            future = ytdl_pool.submit_task(task_id, _extract_audio_url, opts, track_url)
-            
-            audio_url = await asyncio.wrap_future(future)
-            
-            if audio_url:
-                if use_cache:
-                    cache_manager.set(cache_key, audio_url, ttl=1800)
-                return audio_url
-                
-        except Exception as e:
-            logger.warning(f"⚠️ Формат {format_selector} не работает: {e}")
-            continue
+    info = ytdl_pool.stream_entries(opts, search_query, MAX_PLAYLIST_SIZE, publish)
+    if not info:
+        return None
     
-    raise Exception(f"Не удалось получить аудио URL для {title}")
+    record = {"v": TRACK_RECORD_VERSION, "title": info.get("title"), "entries": stream.records}
+    cache_manager.set(f"search:{search_query}", record, ttl=600)
+    return record
+
+async def stream_playlist(search_query, limit, guild_id=None):
+    cached = valid_record(await cache_manager.aget(f"search:{search_query}"))
+    if cached:
+        for record in cached.get("entries", [])[:limit]:
+            yield record
+        return
+    
+    stream = playlist_streams.get(search_query)
+    if stream is None:
+        stream = playlist_streams[search_query] = PlaylistStream(asyncio.get_running_loop())
+        stream.future = ytdl_pool.submit_task(
+            f"playlist:{search_query}", _stream_playlist_entries, stream, search_query,
+            priority=PRIORITY_INTERACTIVE, guild_id=guild_id
+        )
+        stream.future.add_done_callback(stream.close)
+        stream.future.add_done_callback(
+            lambda _: playlist_streams.pop(search_query) if playlist_streams.get(search_query) is stream else None
+        )
+    
+    listener = stream.subscribe()
+    count = 0
+    try:
+        while count < limit:
+            record = await listener.get()
+            if record is None:
+                break
+            count += 1
+            yield record
+    finally:
+        stream.unsubscribe(listener)
+    
+    if not count and stream.future.done() and stream.future.exception():
+        raise stream.future.exception()
 
-def _extract_audio_url(opts, track_url):
-    ytdl_temp = yt_dlp.YoutubeDL(opts)
-    info = ytdl_temp.extract_info(track_url, download=False)
-    return info.get("url") if info else None
+@timed("search")
+def _extract_search(opts, search_query):
+    return ytdl_pool.extract_info(opts, search_query)
 
 def _extract_info_with_cache(search_query):
     cache_key = f"search:{search_query}"
     
-    cached_info = cache_manager.get(cache_key)
+    cached_info = valid_record(cache_manager.get(cache_key))
     if cached_info:
         return cached_info
     
-    is_playlist = "list=" in search_query or "playlist" in search_query.lower()
+    video_id = extract_video_id(search_query)
+    if video_id and "list=" not in search_query:
+        cached_track = valid_record(cache_manager.get(track_cache_key(video_id)))
+        if cached_track and cached_track.get("webpage_url"):
+            return cached_track
     
-    if is_playlist:
-        opts = get_ytdl_opts(extract_flat=True)
-        opts["playlistend"] = MAX_PLAYLIST_SIZE
-        ytdl_temp = yt_dlp.YoutubeDL(opts)
-        info = ytdl_temp.extract_info(search_query, download=False)
-        
-        if info and "entries" in info and info["entries"]:
-            opts_full = get_ytdl_opts(extract_flat=False)
-            
-            for i in range(min(3, len(info["entries"]))):
-                entry = info["entries"][i]
-                if entry and entry.get("url"):
-                    try:
-                        opts_full["playliststart"] = i + 1
-                        opts_full["playlistend"] = i + 1
-                        ytdl_full = yt_dlp.YoutubeDL(opts_full)
-                        full_info = ytdl_full.extract_info(search_query, download=False)
-                        
-                        if full_info and "entries" in full_info and full_info["entries"]:
-                            full_entry = full_info["entries"][0]
-                            info["entries"][i].update({
-                                "url": full_entry.get("url", ""),
-                                "webpage_url": full_entry.get("webpage_url", ""),
-                                "thumbnail": full_entry.get("thumbnail", ""),
-                            })
-                    except Exception as e:
-                        logger.warning(f"⚠️ Предзагрузка трека {i}: {e}")
-    else:
-        opts = get_ytdl_opts(extract_flat=False)
-        ytdl_temp = yt_dlp.YoutubeDL(opts)
-        info = ytdl_temp.extract_info(search_query, download=False)
+    # Плейлисты сюда не попадают, их потоково разбирает ingest_playlist
+    opts = get_ytdl_opts(extract_flat=False)
+    info = _extract_search(opts, search_query)
     
     if info:
+        info = make_search_record(info)
         cache_manager.set(cache_key, info, ttl=600)
+        
+        for record in info.get("entries", [info]):
+            if record.get("id"):
+                cache_manager.set(track_cache_key(record["id"]), record, ttl=3600)
     
     return info
 
@@ -562,17 +2608,11 @@ class MusicPlayerView(discord.ui.View):
                 color=0x2f3136
             )
             queue_text = ""
-            for i, track in enumerate(queue[:10]):
-                if track.get("preloading"):
-                    status_icon = "🚀"
-                elif track.get("lazy_load") and not track.get("loaded"):
-                    status_icon = "⏳"
-                else:
-                    status_icon = "✅"
-                title_display = track['title'][:45] + ('...' if len(track['title']) > 45 else '')
-                queue_text += f"`{i+1}.` {status_icon} **{title_display}**\n*{track['requester']}*\n\n"
-            if len(queue) > 10:
-                queue_text += f"*... и еще {len(queue) - 10} треков*"
+            for i, (icon, title, requester) in enumerate(queue.page(0, QUEUE_PAGE_SIZE)):
+                title_display = title[:45] + ('...' if len(title) > 45 else '')
+                queue_text += f"`{i+1}.` {icon} **{title_display}**\n*{requester}*\n\n"
+            if len(queue) > QUEUE_PAGE_SIZE:
+                queue_text += f"*... и еще {len(queue) - QUEUE_PAGE_SIZE} треков, см. /queue*"
             embed.description = queue_text
             embed.set_footer(text=f"✅ Готов | 🚀 Загружается | ⏳ Ожидает")
             await interaction.response.send_message(embed=embed, ephemeral=True)
@@ -588,14 +2628,14 @@ def create_player_embed(guild_id):
     
     if current_track:
         embed.title = "🎵 Сейчас играет"
-        embed.description = f"**{current_track['title']}**"
+        embed.description = f"**{current_track.title}**"
         
-        embed.add_field(name="👤 Заказал", value=current_track['requester'], inline=True)
+        embed.add_field(name="👤 Заказал", value=current_track.requester, inline=True)
         embed.add_field(name="📃 В очереди", value=f"{len(queue)}/{MAX_QUEUE_SIZE}", inline=True)
         embed.add_field(name="📚 История", value=f"{len(history)}", inline=True)
         
-        if 'thumbnail' in current_track and current_track['thumbnail']:
-            embed.set_thumbnail(url=current_track['thumbnail'])
+        if current_track.thumbnail:
+            embed.set_thumbnail(url=current_track.thumbnail)
     else:
         embed.title = "🎵 Музыкальный плеер"
         embed.description = "*Готов к воспроизведению*"
@@ -611,26 +2651,272 @@ async def delete_old_player(guild_id):
     if guild_id in player_messages:
         try:
             await player_messages[guild_id].delete()
+            player_renderer.stats["deletes"] += 1
         except:
             pass
         player_messages.pop(guild_id, None)
 
-async def create_new_player(guild_id, channel):
-    if not channel:
-        return
+class PlayerRenderer:
+    def __init__(self):
+        self.pending = {}
+        self.last_render = {}
+        self.buried = {}
+        self.stats = {"requests": 0, "coalesced": 0, "edits": 0, "sends": 0, "deletes": 0}
+    
+    def request_update(self, guild_id, channel=None):
+        if channel:
+            player_channels[guild_id] = channel
+        
+        self.stats["requests"] += 1
+        if guild_id in self.pending:
+            self.stats["coalesced"] += 1
+            return
+        
+        delay = self.last_render.get(guild_id, 0) + PLAYER_UPDATE_INTERVAL - time.monotonic()
+        self.pending[guild_id] = asyncio.create_task(self._render_later(guild_id, max(0, delay)))
     
-    await delete_old_player(guild_id)
+    async def _render_later(self, guild_id, delay):
+        try:
+            await asyncio.sleep(delay)
+        finally:
+            if self.pending.get(guild_id) is asyncio.current_task():
+                del self.pending[guild_id]
+        
+        self.last_render[guild_id] = time.monotonic()
+        await self.render(guild_id)
     
-    embed = create_player_embed(guild_id)
-    view = MusicPlayerView(guild_id)
+    async def render(self, guild_id):
+        channel = player_channels.get(guild_id)
+        if not channel:
+            return False
+        
+        embed = create_player_embed(guild_id)
+        player_msg = player_messages.get(guild_id)
+        
+        if (player_msg and player_msg.channel.id == channel.id
+                and self.buried.get(guild_id, 0) < PLAYER_RESEND_AFTER):
+            try:
+                await player_msg.edit(embed=embed)
+                self.stats["edits"] += 1
+                return True
+            except discord.NotFound:
+                player_messages.pop(guild_id, None)
+            except Exception as e:
+                logger.warning(f"⚠️ Ошибка обновления плеера: {e}")
+                return False
+        
+        await delete_old_player(guild_id)
+        
+        try:
+            player_messages[guild_id] = await channel.send(embed=embed, view=MusicPlayerView(guild_id))
+            self.buried[guild_id] = 0
+            self.stats["sends"] += 1
+            return True
+        except Exception:
+            return False
     
-    try:
-        player_msg = await channel.send(embed=embed, view=view)
-        player_messages[guild_id] = player_msg
-        player_channels[guild_id] = channel
-        return True
-    except Exception:
-        return False
+    def note_message(self, message):
+        if not message.guild:
+            return
+        
+        player_msg = player_messages.get(message.guild.id)
+        if player_msg and message.channel.id == player_msg.channel.id and message.id != player_msg.id:
+            self.buried[message.guild.id] = self.buried.get(message.guild.id, 0) + 1
+    
+    def forget(self, guild_id):
+        task = self.pending.pop(guild_id, None)
+        if task:
+            task.cancel()
+        self.last_render.pop(guild_id, None)
+        self.buried.pop(guild_id, None)
+    
+    def get_stats(self):
+        rest_calls = self.stats["edits"] + self.stats["sends"] + self.stats["deletes"]
+        return {**self.stats, "saved": max(0, self.stats["requests"] * 2 - rest_calls)}
+
+player_renderer = PlayerRenderer()
+
+class StateStore:
+    def __init__(self):
+        self.dirty = set()
+        self.flush_task = None
+        self.restored = False
+    
+    def mark_dirty(self, guild_id):
+        if not cache_manager.conn:
+            return
+        
+        self.dirty.add(guild_id)
+        if not self.flush_task:
+            self.flush_task = asyncio.create_task(self._flush_later())
+    
+    async def _flush_later(self):
+        try:
+            await asyncio.sleep(STATE_SAVE_INTERVAL)
+        finally:
+            self.flush_task = None
+        
+        dirty, self.dirty = self.dirty, set()
+        rows = []
+        deleted = []
+        for guild_id in dirty:
+            row = self.snapshot(guild_id)
+            if row:
+                rows.append(row)
+            else:
+                deleted.append(guild_id)
+        
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(cache_manager.executor, self._write, rows, deleted)
+    
+    def snapshot(self, guild_id):
+        guild = bot.get_guild(guild_id)
+        vc = guild.voice_client if guild else None
+        if not vc or not vc.channel:
+            return None
+        
+        current = current_tracks.get(guild_id)
+        position = self.position(vc) if current else 0
+        
+        text_channel = player_channels.get(guild_id)
+        
+        return (
+            guild_id,
+            vc.channel.id,
+            text_channel.id if text_channel else None,
+            json.dumps(current.to_state()) if current else None,
+            position,
+            json.dumps([track.to_state() for track in get_queue(guild_id)]),
+            json.dumps([track.to_state() for track in get_history(guild_id)]),
+            int(time.time()),
+        )
+    
+    @staticmethod
+    def position(vc):
+        return vc.source.position if isinstance(vc.source, PlaybackSource) else 0
+    
+    async def save_positions(self):
+        # Позиция меняется постоянно, поэтому пишется отдельно, без пересериализации очереди и истории
+        if not cache_manager.conn:
+            return
+        
+        now = int(time.time())
+        rows = []
+        for guild_id, track in list(current_tracks.items()):
+            guild = bot.get_guild(guild_id)
+            vc = guild.voice_client if guild else None
+            if track and vc and vc.is_playing():
+                rows.append((self.position(vc), now, guild_id))
+        
+        if rows:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(cache_manager.executor, self._write_positions, rows)
+    
+    def _write_positions(self, rows):
+        try:
+            with cache_manager.db_lock:
+                cache_manager.conn.executemany(
+                    'UPDATE guild_state SET position = ?, updated_at = ? WHERE guild_id = ?', rows
+                )
+                cache_manager.conn.commit()
+        except Exception as e:
+            logger.warning(f"⚠️ Ошибка сохранения позиции: {e}")
+    
+    def _write(self, rows, deleted):
+        try:
+            with cache_manager.db_lock:
+                cache_manager.conn.executemany(
+                    'INSERT OR REPLACE INTO guild_state VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    rows
+                )
+                cache_manager.conn.executemany(
+                    'DELETE FROM guild_state WHERE guild_id = ?',
+                    [(guild_id,) for guild_id in deleted]
+                )
+                cache_manager.conn.commit()
+        except Exception as e:
+            logger.warning(f"⚠️ Ошибка сохранения состояния: {e}")
+    
+    def _read_all(self):
+        with cache_manager.db_lock:
+            return cache_manager.conn.execute(
+                'SELECT guild_id, voice_channel_id, text_channel_id, current, position, queue, history '
+                'FROM guild_state'
+            ).fetchall()
+    
+    def forget(self, guild_id):
+        self.dirty.discard(guild_id)
+        if cache_manager.conn:
+            cache_manager.executor.submit(self._write, [], [guild_id])
+    
+    async def restore(self):
+        if self.restored or not cache_manager.conn:
+            return
+        self.restored = True
+        
+        loop = asyncio.get_running_loop()
+        try:
+            rows = await loop.run_in_executor(cache_manager.executor, self._read_all)
+        except Exception as e:
+            logger.warning(f"⚠️ Ошибка чтения состояния: {e}")
+            return
+        
+        for row in rows:
+            if not owns_guild(row[0]):
+                continue
+            try:
+                await self._restore_guild(*row)
+            except Exception as e:
+                logger.error(f"❌ Ошибка восстановления очереди: {e}")
+                await self._abandon(row[0])
+    
+    async def _abandon(self, guild_id):
+        # Иначе восстановленные треки остались бы в памяти и заиграли бы перед следующим /play
+        guild = bot.get_guild(guild_id)
+        if guild and guild.voice_client:
+            try:
+                await guild.voice_client.disconnect(force=True)
+            except Exception:
+                pass
+        track_history.pop(guild_id, None)
+        await cleanup_guild_data(guild_id)
+    
+    async def _restore_guild(self, guild_id, voice_channel_id, text_channel_id, current, position, queue_data, history_data):
+        guild = bot.get_guild(guild_id)
+        voice_channel = guild.get_channel(voice_channel_id) if guild else None
+        if not voice_channel or not any(not member.bot for member in voice_channel.members):
+            self.forget(guild_id)
+            return
+        
+        queue = get_queue(guild_id)
+        for data in json.loads(queue_data or "[]"):
+            if "cursor" in data:
+                queue.append_cursor(PlaylistCursor.from_state(data))
+            else:
+                queue.append(Track.from_state(data))
+        
+        history = get_history(guild_id)
+        for data in json.loads(history_data or "[]"):
+            history.append(Track.from_state(data))
+        
+        if current:
+            track = Track.from_state(json.loads(current))
+            track.resume_at = position or 0
+            queue.appendleft(track)
+        
+        if not queue:
+            self.forget(guild_id)
+            return
+        
+        text_channel = guild.get_channel(text_channel_id) if text_channel_id else None
+        if text_channel:
+            player_channels[guild_id] = text_channel
+        
+        vc = await safe_voice_connect(voice_channel)
+        logger.info(f"♻️ Восстановлена очередь {guild.name}: {len(queue)} треков")
+        await play_next(vc, guild_id)
+
+state_store = StateStore()
 
 async def play_next_safe(vc, guild_id):
     try:
@@ -638,19 +2924,162 @@ async def play_next_safe(vc, guild_id):
     except Exception as e:
         logger.error(f"❌ Ошибка в play_next_safe: {e}")
 
+metrics.gauge("vexel_ytdlp_queue_depth", "Задачи yt-dlp в очереди", lambda: ytdl_pool.get_stats()["queued"])
+metrics.gauge("vexel_ytdlp_active_workers", "Занятые потоки yt-dlp", lambda: ytdl_pool.get_stats()["active"])
+metrics.gauge("vexel_ytdlp_workers", "Всего потоков yt-dlp", lambda: ytdl_pool.max_workers)
+metrics.gauge("vexel_voice_clients", "Активные голосовые подключения", lambda: len(bot.voice_clients))
+metrics.gauge("vexel_cache_memory_entries", "Записи в кэше в памяти", lambda: cache_manager.get_stats()["entries"])
+metrics.gauge("vexel_cache_memory_bytes", "Объем кэша в памяти", lambda: cache_manager.get_stats()["bytes"])
+metrics.gauge("vexel_audio_worker_streams", "Потоки в аудиоворкерах", lambda: audio_workers.get_stats()["streams"])
+metrics.gauge("vexel_audio_worker_underruns", "Недогрузки буфера аудиоворкеров", lambda: audio_workers.underruns)
+
+class LoopWatchdog:
+    def __init__(self, threshold, interval=0.1):
+        self.threshold = threshold
+        self.interval = interval
+        self.last_beat = time.monotonic()
+        self.loop_thread_id = None
+        self.source_dir = os.path.dirname(os.path.abspath(__file__))
+        self.lock = threading.Lock()
+        self.offenders = {}
+        self.stall_samples = []
+        self.stalls = 0
+        self.max_lag = 0
+        self.started = False
+        self.sampling = False
+    
+    def start(self, sample_stacks=True):
+        # Heartbeat нужен и для гистограммы задержки, стеки снимаются только при включенном watchdog
+        if self.started:
+            return
+        self.started = True
+        self.sampling = sample_stacks
+        self.loop_thread_id = threading.get_ident()
+        self.last_beat = time.monotonic()
+        asyncio.create_task(self._heartbeat())
+        if sample_stacks:
+            threading.Thread(target=self._watch, name="LoopWatchdog", daemon=True).start()
+    
+    async def _heartbeat(self):
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self.last_beat = now
+            
+            lag = max(0, now - start - self.interval)
+            metrics.observe("vexel_event_loop_lag_seconds", lag)
+            if self.sampling and lag >= self.threshold:
+                self._finish_stall(lag)
+    
+    def _watch(self):
+        sample_interval = self.interval / 2
+        while True:
+            time.sleep(sample_interval)
+            if time.monotonic() - self.last_beat - self.interval < self.threshold:
+                continue
+            
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is None:
+                continue
+            stack = traceback.extract_stack(frame)
+            del frame
+            
+            key = self._offender(stack)
+            with self.lock:
+                entry = self.offenders.get(key)
+                if entry is None:
+                    entry = self.offenders[key] = {"samples": 0, "seconds": 0.0, "stalls": 0, "stack": ""}
+                entry["samples"] += 1
+                entry["seconds"] += sample_interval
+                entry["stack"] = "".join(traceback.format_list(stack[-8:]))
+                self.stall_samples.append(key)
+    
+    def _offender(self, stack):
+        innermost = stack[-1]
+        own = next((f for f in reversed(stack) if f.filename.startswith(self.source_dir)), innermost)
+        key = f"{own.name} ({os.path.basename(own.filename)}:{own.lineno})"
+        if own is not innermost:
+            key += f" → {innermost.name} ({os.path.basename(innermost.filename)}:{innermost.lineno})"
+        return key
+    
+    def _finish_stall(self, lag):
+        with self.lock:
+            samples, self.stall_samples = self.stall_samples, []
+            self.stalls += 1
+            self.max_lag = max(self.max_lag, lag)
+            culprit = max(set(samples), key=samples.count) if samples else None
+            if culprit:
+                self.offenders[culprit]["stalls"] += 1
+        
+        logger.warning(f"🐢 Event loop заблокирован на {lag * 1000:.0f} мс: {culprit or 'стек не снят'}")
+    
+    def top(self, count=5):
+        with self.lock:
+            items = sorted(self.offenders.items(), key=lambda item: item[1]["seconds"], reverse=True)
+            return [(key, dict(entry)) for key, entry in items[:count]]
+    
+    def dump(self, count=5):
+        for key, entry in self.top(count):
+            logger.info(
+                f"🐢 {key}: {entry['seconds']:.2f} с в {entry['stalls']} блокировках\n{entry['stack']}"
+            )
+
+loop_watchdog = LoopWatchdog(LOOP_LAG_THRESHOLD)
+
+async def start_metrics_server():
+    from aiohttp import web
+    
+    async def handle_metrics(request):
+        return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+    
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    logger.info(f"📈 Метрики: http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+
+async def save_state_periodic():
+    while True:
+        try:
+            await asyncio.sleep(STATE_POSITION_INTERVAL)
+            await state_store.save_positions()
+        except Exception as e:
+            logger.error(f"❌ Ошибка сохранения состояния: {e}")
+
 async def cleanup_cache_periodic():
     while True:
         try:
             await asyncio.sleep(1800)
-            cache_manager.cleanup()
-            logger.info("🧹 Очистка кэша")
+            await cache_manager.acleanup()
+            stats = cache_manager.get_stats()
+            logger.info(
+                f"🧹 Очистка кэша: {stats['entries']} записей, {stats['bytes'] // 1024} КБ, "
+                f"попаданий {stats['hits']}, промахов {stats['misses']}, вытеснено {stats['evictions']}"
+            )
+            player_stats = player_renderer.get_stats()
+            logger.info(
+                f"🖼️ Плеер: {player_stats['requests']} обновлений, {player_stats['edits']} правок, "
+                f"{player_stats['sends']} отправок, сэкономлено {player_stats['saved']} запросов"
+            )
+            if loop_watchdog.stalls:
+                logger.info(
+                    f"🐢 Блокировок event loop: {loop_watchdog.stalls}, "
+                    f"максимум {loop_watchdog.max_lag * 1000:.0f} мс"
+                )
+                loop_watchdog.dump(3)
         except Exception as e:
             logger.error(f"❌ Ошибка очистки кэша: {e}")
 
+startup_done = False
+
 @bot.event
 async def on_ready():
     logger.info(f"✅ Запущен: {bot.user}")
     logger.info(f"📊 Лимиты: плейлист {MAX_PLAYLIST_SIZE}, очередь {MAX_QUEUE_SIZE}")
+    if bot.shard_count:
+        logger.info(f"🧩 Шарды {getattr(bot, 'shard_ids', None) or 'все'} из {bot.shard_count}")
     
     bot.add_view(MusicPlayerView(None))
     
@@ -659,7 +3088,23 @@ async def on_ready():
         name="/play"
     ))
     
-    asyncio.create_task(cleanup_cache_periodic())
+    # on_ready повторяется при каждом переподключении, фоновые задачи запускаем один раз
+    global startup_done
+    if not startup_done:
+        startup_done = True
+        asyncio.create_task(cleanup_cache_periodic())
+        asyncio.create_task(state_store.restore())
+        asyncio.create_task(save_state_periodic())
+        asyncio.create_task(publish_shard_stats_periodic())
+        if CACHE_WARMUP_TOP:
+            asyncio.create_task(play_stats.warm_up_periodic())
+        if LOOP_WATCHDOG or METRICS_PORT:
+            loop_watchdog.start(sample_stacks=LOOP_WATCHDOG)
+        if METRICS_PORT:
+            try:
+                await start_metrics_server()
+            except Exception as e:
+                logger.error(f"❌ Не удалось запустить сервер метрик: {e}")
     
     try:
         synced = await tree.sync()
@@ -667,6 +3112,10 @@ async def on_ready():
     except Exception as e:
         logger.error(f"❌ Ошибка синхронизации: {e}")
 
+@bot.listen("on_message")
+async def on_player_channel_message(message):
+    player_renderer.note_message(message)
+
 @bot.event
 async def on_voice_state_update(member, before, after):
     if member.bot:
@@ -729,13 +3178,21 @@ async def play(interaction: discord.Interaction, query: str):
     except Exception:
         return
 
-    search_query = f"ytsearch1:{clean_search_query(query)}" if not (query.startswith("http://") or query.startswith("https://")) else query
+    search_query = canonical_query(query)
+
+    if is_playlist_query(search_query):
+        logger.info(f"📃 Плейлист: {query}")
+        await ingest_playlist(interaction, vc, search_query)
+        return
 
     try:
         logger.info(f"🔍 Запрос: {query}")
         
         task_id = f"search:{search_query}"
-        future = ytdl_pool.submit_task(task_id, _extract_info_with_cache, search_query)
+        future = ytdl_pool.submit_task(
+            task_id, _extract_info_with_cache, search_query,
+            priority=PRIORITY_INTERACTIVE, guild_id=interaction.guild.id
+        )
         info = await asyncio.wrap_future(future)
         
         logger.info(f"✅ Получен ответ от yt-dlp")
@@ -762,36 +3219,27 @@ async def play(interaction: discord.Interaction, query: str):
         entries_to_process = info["entries"][:max_to_add]
         
         added_count = 0
+        ready_count = 0
         for i, entry in enumerate(entries_to_process):
             if entry and entry.get("title"):
-                has_full_info = entry.get("url") and entry.get("webpage_url")
+                has_full_info = bool(entry.get("url") and entry.get("webpage_url"))
                 
-                track_data = {
-                    "title": entry.get("title", f"Track {i+1}"),
-                    "playlist_url": search_query,
-                    "playlist_index": i,
-                    "lazy_load": not has_full_info,
-                    "loaded": has_full_info,
-                    "preloading": False,
-                    "requester": interaction.user.name,
-                }
+                track = Track.from_record(
+                    entry,
+                    interaction.user.name,
+                    playlist_url=search_query,
+                    playlist_index=i,
+                    lazy_load=not has_full_info
+                )
                 
-                if has_full_info:
-                    track_data.update({
-                        "url": entry.get("url", ""),
-                        "webpage_url": entry.get("webpage_url", ""),
-                        "thumbnail": entry.get("thumbnail", ""),
-                    })
-                
-                queue.append(track_data)
+                queue.append(track)
                 added_count += 1
+                ready_count += has_full_info
         
-        lazy_tracks = [track for track in queue if track.get("lazy_load")]
-        if lazy_tracks:
-            asyncio.create_task(preload_manager.preload_tracks(interaction.guild.id, 5))
+        if queue.has_unresolved():
+            asyncio.create_task(preload_manager.preload_tracks(interaction.guild.id, PRELOAD_ON_ADD))
         
         try:
-            ready_count = sum(1 for track in queue[-added_count:] if track.get("loaded"))
             message = f"📃 **Добавлено {added_count} из {total_entries} треков**\n"
             
             if ready_count > 0:
@@ -807,120 +3255,189 @@ async def play(interaction: discord.Interaction, query: str):
             
     elif info.get("title"):
         # Одиночный трек
-        track = {
-            "title": info["title"],
-            "url": info.get("url", ""),
-            "webpage_url": info.get("webpage_url", ""),
-            "thumbnail": info.get("thumbnail", ""),
-            "requester": interaction.user.name,
-            "lazy_load": False,
-            "loaded": True,
-        }
+        track = Track.from_record(info, interaction.user.name)
         queue.append(track)
         
         try:
             await interaction.edit_original_response(
-                content=f"🎶 **Добавлен:** {track['title']}\n📊 Очередь: {len(queue)}/{MAX_QUEUE_SIZE}"
+                content=f"🎶 **Добавлен:** {track.title}\n📊 Очередь: {len(queue)}/{MAX_QUEUE_SIZE}"
             )
         except:
             pass
 
-    player_channels[interaction.guild.id] = interaction.channel
-    await create_new_player(interaction.guild.id, interaction.channel)
+    player_renderer.request_update(interaction.guild.id, interaction.channel)
+    state_store.mark_dirty(interaction.guild.id)
 
     if not vc.is_playing():
         await play_next(vc, interaction.guild.id)
+    else:
+        preload_manager.schedule(interaction.guild.id)
+
+async def ingest_playlist(interaction, vc, search_query):
+    guild_id = interaction.guild.id
+    queue = get_queue(guild_id)
+    limit = min(MAX_PLAYLIST_SIZE, MAX_QUEUE_SIZE - len(queue))
+    
+    added_count = 0
+    ready_count = 0
+    started = False
+    starting = None
+    cursor = None
+    last_progress = time.monotonic()
+    
+    async def report(content):
+        try:
+            await interaction.edit_original_response(content=content)
+        except:
+            pass
+    
+    def start_if_idle():
+        # Очередь могла опустеть раньше, чем пришли следующие записи (ошибки загрузки, скипы)
+        nonlocal starting
+        if starting and not starting.done():
+            return True
+        # current_tracks сбрасывается только на пустой очереди, иначе трек уже доигрывает и play_next придет сам
+        if (current_tracks.get(guild_id) is None and vc.is_connected() and not vc.is_playing()
+                and not vc.is_paused() and not get_play_lock(guild_id).locked()):
+            starting = asyncio.create_task(play_next(vc, guild_id))
+            return True
+        return False
+    
+    try:
+        async for entry in stream_playlist(search_query, limit, guild_id):
+            if added_count < QUEUE_WINDOW:
+                has_full_info = bool(entry.get("url") and entry.get("webpage_url"))
+                queue.append(Track.from_record(
+                    entry,
+                    interaction.user.name,
+                    playlist_url=search_query,
+                    playlist_index=added_count,
+                    lazy_load=not has_full_info
+                ))
+                ready_count += has_full_info
+            else:
+                # Остаток плейлиста хранится курсором и материализуется по мере воспроизведения
+                if cursor is None:
+                    cursor = PlaylistCursor(search_query, interaction.user.name, base_index=added_count, streaming=True)
+                    queue.append_cursor(cursor)
+                queue.extend_cursor(cursor, entry)
+            added_count += 1
+            
+            # Первый трек запускаем сразу, остальные догружаются параллельно
+            if not start_if_idle() and not started:
+                preload_manager.schedule(guild_id)
+            if not started:
+                started = True
+                player_renderer.request_update(guild_id, interaction.channel)
+            
+            if time.monotonic() - last_progress >= PLAYER_UPDATE_INTERVAL:
+                last_progress = time.monotonic()
+                await report(f"📃 **Загружаю плейлист...** добавлено {added_count}\n📊 Очередь: {len(queue)}/{MAX_QUEUE_SIZE}")
+                player_renderer.request_update(guild_id)
+    except Exception as e:
+        logger.error(f"❌ Ошибка yt-dlp: {str(e)}")
+        if not added_count:
+            await report(f"❌ Ошибка: {str(e)}")
+            return
+    finally:
+        if cursor:
+            queue.close_cursor(cursor)
+    
+    if not added_count:
+        await report("❌ **Не найдено**")
+        return
+    
+    logger.info(f"✅ Плейлист добавлен: {added_count} треков")
+    start_if_idle()
+    
+    if queue.has_unresolved():
+        asyncio.create_task(preload_manager.preload_tracks(guild_id, PRELOAD_ON_ADD))
+    preload_manager.schedule(guild_id)
+    
+    message = f"📃 **Добавлено {added_count} треков**\n"
+    if ready_count > 0:
+        message += f"✅ {ready_count} треков готовы\n"
+    if added_count - ready_count > 0:
+        message += f"⏳ {added_count - ready_count} загружаются\n"
+    message += f"📊 Очередь: {len(queue)}/{MAX_QUEUE_SIZE}"
+    await report(message)
+    
+    player_renderer.request_update(guild_id, interaction.channel)
+    state_store.mark_dirty(guild_id)
 
 async def play_next(vc, guild_id):
     lock = get_play_lock(guild_id)
     async with lock:
         try:
-            queue = get_queue(guild_id)
-            if not queue:
-                current_tracks[guild_id] = None
-                logger.info("📭 Очередь пуста")
-                channel = player_channels.get(guild_id)
-                if channel:
-                    await create_new_player(guild_id, channel)
-                return
+            while not await _start_next_track(vc, guild_id):
+                pass
+        except Exception as e:
+            logger.error(f"❌ Критическая ошибка в play_next: {e}")
 
-            if not vc or not vc.is_connected():
-                logger.warning("⚠️ Voice client отключен")
-                await cleanup_guild_data(guild_id)
-                return
+async def _start_next_track(vc, guild_id):
+    queue = get_queue(guild_id)
+    if not queue:
+        current_tracks[guild_id] = None
+        transition_starts.pop(guild_id, None)
+        playing_sources.pop(guild_id, None)
+        logger.info("📭 Очередь пуста")
+        player_renderer.request_update(guild_id)
+        state_store.mark_dirty(guild_id)
+        return True
 
-            current_track = current_tracks.get(guild_id)
-            if current_track:
-                add_to_history(guild_id, current_track)
+    if not vc or not vc.is_connected():
+        logger.warning("⚠️ Voice client отключен")
+        await cleanup_guild_data(guild_id)
+        return True
 
-            next_track = queue.pop(0)
-            current_tracks[guild_id] = next_track
-            logger.info(f"⏭️ Следующий: {next_track['title']}")
-            
-            remaining_lazy = [track for track in queue if track.get("lazy_load")]
-            if remaining_lazy:
-                asyncio.create_task(preload_manager.preload_tracks(guild_id, 3))
-            
-            if next_track.get("lazy_load") and not next_track.get("loaded"):
-                try:
-                    cache_key = f"track_full:{next_track['playlist_url']}:{next_track['playlist_index']}"
-                    
-                    cached_data = cache_manager.get(cache_key)
-                    if cached_data:
-                        next_track.update(cached_data)
-                        next_track["loaded"] = True
-                    else:
-                        full_info = await preload_manager._load_track_metadata(
-                            next_track["playlist_url"], 
-                            next_track["playlist_index"]
-                        )
-                        
-                        if full_info:
-                            cache_manager.set(cache_key, full_info, ttl=3600)
-                            next_track.update(full_info)
-                            next_track["loaded"] = True
-                        else:
-                            raise Exception("Не удалось загрузить трек")
-                        
-                except Exception as e:
-                    logger.error(f"❌ Ошибка загрузки: {e}")
-                    await play_next(vc, guild_id)
-                    return
-            
-            try:
-                if next_track.get("url"):
-                    audio_url = await get_audio_url(next_track["url"], next_track["title"])
-                else:
-                    logger.error(f"❌ Нет URL: {next_track['title']}")
-                    await play_next(vc, guild_id)
-                    return
-                
-                source = create_source(audio_url)
-                
-                def after_play(error):
-                    if error:
-                        logger.error(f"❌ Ошибка воспроизведения: {error}")
-                    
-                    bot.loop.create_task(play_next_safe(vc, guild_id))
-                
-                if vc.is_playing():
-                    vc.stop()
-                    await asyncio.sleep(0.2)
-                
-                vc.play(source, after=after_play)
-                logger.info(f"🎵 Играет: {next_track['title']}")
-                
-            except Exception as e:
-                logger.error(f"❌ Ошибка воспроизведения: {e}")
-                await play_next(vc, guild_id)
-                return
-            
-            channel = player_channels.get(guild_id)
-            if channel:
-                await create_new_player(guild_id, channel)
-                
+    current_track = current_tracks.get(guild_id)
+    if current_track:
+        add_to_history(guild_id, current_track)
+
+    next_track = queue.popleft()
+    current_tracks[guild_id] = next_track
+    logger.info(f"⏭️ Следующий: {next_track.title}")
+    
+    source = take_staged_source(guild_id, next_track)
+    
+    if not source and next_track.needs_load:
+        try:
+            if not await preload_manager.load_track(next_track, PRIORITY_NEXT, guild_id):
+                raise Exception("Не удалось загрузить трек")
         except Exception as e:
-            logger.error(f"❌ Критическая ошибка в play_next: {e}")
+            logger.error(f"❌ Ошибка загрузки: {e}")
+            return False
+    
+    try:
+        if not source:
+            if next_track.source_url:
+                stream = await resolve_stream(next_track, guild_id)
+            else:
+                logger.error(f"❌ Нет URL: {next_track.title}")
+                return False
+            
+            source = create_source(
+                stream["url"], stream["acodec"], start=next_track.resume_at, local=stream["local"]
+            )
+            next_track.resume_at = 0
+        
+        if vc.is_playing():
+            vc.stop()
+            await asyncio.sleep(0.2)
+        
+        start_playback(vc, guild_id, next_track, source)
+        logger.info(f"🎵 Играет: {next_track.title}")
+        play_stats.record(next_track, guild_id)
+        schedule_staging(guild_id, next_track, source.position)
+        preload_manager.schedule(guild_id)
+        
+    except Exception as e:
+        logger.error(f"❌ Ошибка воспроизведения: {e}")
+        return False
+    
+    player_renderer.request_update(guild_id)
+    state_store.mark_dirty(guild_id)
+    return True
 
 @tree.command(name="pause", description="Пауза")
 async def pause(interaction: discord.Interaction):
@@ -959,32 +3476,27 @@ async def skip(interaction: discord.Interaction):
         await interaction.response.send_message("❌ Ничего не играет", ephemeral=True)
 
 @tree.command(name="queue", description="Показать очередь")
-async def queue_cmd(interaction: discord.Interaction):
+@app_commands.describe(page="Номер страницы")
+async def queue_cmd(interaction: discord.Interaction, page: app_commands.Range[int, 1] = 1):
     queue = get_queue(interaction.guild.id)
     
     if not queue:
         await interaction.response.send_message(f"📭 Очередь пуста (0/{MAX_QUEUE_SIZE})", ephemeral=True)
         return
     
+    pages = (len(queue) + QUEUE_PAGE_SIZE - 1) // QUEUE_PAGE_SIZE
+    page = min(page, pages)
+    start = (page - 1) * QUEUE_PAGE_SIZE
+    
     embed = discord.Embed(title=f"📃 Очередь ({len(queue)}/{MAX_QUEUE_SIZE})", color=0x2f3136)
     
     queue_text = ""
-    for i, track in enumerate(queue[:10]):
-        if track.get("preloading"):
-            status_icon = "🚀"
-        elif track.get("lazy_load") and not track.get("loaded"):
-            status_icon = "⏳"
-        else:
-            status_icon = "✅"
-        
-        title = track['title'][:40] + ('...' if len(track['title']) > 40 else '')
-        queue_text += f"`{i+1}.` {status_icon} **{title}**\n"
-    
-    if len(queue) > 10:
-        queue_text += f"*... и еще {len(queue) - 10} треков*"
+    for i, (icon, title, _) in enumerate(queue.page(start, QUEUE_PAGE_SIZE), start=start + 1):
+        title = title[:40] + ('...' if len(title) > 40 else '')
+        queue_text += f"`{i}.` {icon} **{title}**\n"
     
     embed.description = queue_text
-    embed.set_footer(text="✅ Готов | 🚀 Загружается | ⏳ Ожидает")
+    embed.set_footer(text=f"Страница {page}/{pages} • ✅ Готов | 🚀 Загружается | ⏳ Ожидает")
     await interaction.response.send_message(embed=embed, ephemeral=True)
 
 @tree.command(name="history", description="История треков")
@@ -1000,8 +3512,8 @@ async def history_cmd(interaction: discord.Interaction):
     embed = discord.Embed(title=f"📚 История ({len(history)})", color=0x2f3136)
     
     history_text = ""
-    for i, track in enumerate(reversed(history[-10:])):
-        title = track['title'][:40] + ('...' if len(track['title']) > 40 else '')
+    for i, track in enumerate(itertools.islice(reversed(history), 10)):
+        title = track.title[:40] + ('...' if len(track.title) > 40 else '')
         history_text += f"`{len(history)-i}.` **{title}**\n"
     
     if len(history) > 10:
@@ -1011,6 +3523,86 @@ async def history_cmd(interaction: discord.Interaction):
     embed.set_footer(text="Последние 10 треков")
     await interaction.response.send_message(embed=embed, ephemeral=True)
 
+@tree.command(name="lag", description="Блокировки event loop")
+@app_commands.default_permissions(manage_guild=True)
+async def lag_cmd(interaction: discord.Interaction):
+    log_command(interaction.user.name, "/lag")
+    
+    if not loop_watchdog.sampling:
+        await interaction.response.send_message("❌ Watchdog выключен (LOOP_WATCHDOG=false).", ephemeral=True)
+        return
+    
+    embed = discord.Embed(
+        title="🐢 Блокировки event loop",
+        description=(
+            f"Порог {LOOP_LAG_THRESHOLD * 1000:.0f} мс • блокировок {loop_watchdog.stalls} • "
+            f"максимум {loop_watchdog.max_lag * 1000:.0f} мс"
+        ),
+        color=0x2f3136
+    )
+    
+    for key, entry in loop_watchdog.top(5):
+        stack = entry["stack"][-700:]
+        embed.add_field(
+            name=f"{entry['seconds']:.2f} с • {entry['stalls']} раз • {key}"[:256],
+            value=f"```{stack}```",
+            inline=False
+        )
+    
+    if not embed.fields:
+        embed.add_field(name="✅ Чисто", value="Блокировок выше порога не было", inline=False)
+    
+    loop_watchdog.dump()
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+@tree.command(name="stats", description="Статистика шардов")
+async def stats_cmd(interaction: discord.Interaction):
+    log_command(interaction.user.name, "/stats")
+    
+    rows = []
+    if cache_manager.conn:
+        loop = asyncio.get_running_loop()
+        rows = await loop.run_in_executor(cache_manager.executor, _read_shard_stats)
+    
+    if not rows:
+        rows = shard_stats_rows()
+    
+    embed = discord.Embed(title="📊 Статистика", color=0x2f3136)
+    
+    shards_text = ""
+    now = int(time.time())
+    for shard_id, pid, guilds, voice_clients, latency_ms, queued_tracks, updated_at in rows:
+        stale = " ⚠️" if now - updated_at > SHARD_STATS_INTERVAL * 3 else ""
+        shards_text += (
+            f"`#{shard_id}` PID {pid} • 🏠 {guilds} • 🔊 {voice_clients} • "
+            f"📃 {queued_tracks} • 📶 {f'{latency_ms} мс' if latency_ms >= 0 else '—'}{stale}\n"
+        )
+    embed.add_field(name="🧩 Шарды", value=shards_text[:1024] or "—", inline=False)
+    
+    cache_stats = cache_manager.get_stats()
+    pool_stats = ytdl_pool.get_stats()
+    audio_stats = audio_workers.get_stats()
+    embed.add_field(
+        name="⚙️ Этот процесс",
+        value=(
+            f"Кэш: {cache_stats['entries']} записей, {cache_stats['bytes'] // 1024} КБ, "
+            f"попаданий {cache_stats['hits']}, промахов {cache_stats['misses']}\n"
+            f"yt-dlp: {pool_stats['active']}/{pool_stats['workers']} занято, {pool_stats['queued']} в очереди"
+            + (
+                f", процессов {pool_stats['processes']}, задач {pool_stats['jobs']}"
+                if pool_stats["backend"] == "process" else ""
+            )
+            + (
+                f"\nАудиоворкеры: {audio_stats['workers']}, потоков {audio_stats['streams']}, "
+                f"недогрузок {audio_stats['underruns']}"
+                if audio_workers.enabled else ""
+            )
+        ),
+        inline=False
+    )
+    
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
 @tree.command(name="help", description="Справка")
 async def help_cmd(interaction: discord.Interaction):
     try:
@@ -1022,7 +3614,7 @@ async def help_cmd(interaction: discord.Interaction):
         )
         embed.add_field(
             name="📃 Информация",
-            value="`/queue` - Очередь\n`/history` - История",
+            value="`/queue` - Очередь\n`/history` - История\n`/stats` - Статистика",
             inline=False
         )
         embed.add_field(
@@ -1041,11 +3633,60 @@ async def help_cmd(interaction: discord.Interaction):
     except Exception as e:
         logger.error(f"❌ Ошибка /help: {e}")
 
+def run_launcher():
+    shard_count = SHARD_COUNT or BOT_PROCESSES
+    shard_ids = list(range(shard_count))
+    # Процесс без шардов получил бы пустой SHARD_IDS и подключил бы все шарды сразу
+    process_count = min(BOT_PROCESSES, shard_count)
+    if process_count < BOT_PROCESSES:
+        logger.warning(f"⚠️ BOT_PROCESSES={BOT_PROCESSES} больше числа шардов, запускается {process_count}")
+    groups = [shard_ids[i::process_count] for i in range(process_count)]
+    
+    def spawn(group):
+        env = {
+            **os.environ,
+            "BOT_PROCESSES": "1",
+            "SHARD_COUNT": str(shard_count),
+            "SHARD_IDS": ",".join(map(str, group)),
+            "METRICS_PORT": str(METRICS_PORT + groups.index(group)) if METRICS_PORT else "0",
+        }
+        logger.info(f"🧩 Запуск процесса для шардов {group}")
+        return subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env)
+    
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    processes = [spawn(group) for group in groups]
+    
+    try:
+        while True:
+            time.sleep(5)
+            for i, process in enumerate(processes):
+                if process.poll() is not None:
+                    logger.warning(f"⚠️ Процесс шардов {groups[i]} завершился ({process.returncode}), перезапуск")
+                    processes[i] = spawn(groups[i])
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
 if __name__ == "__main__":
     if not TOKEN:
         logger.error("❌ DISCORD_TOKEN не найден")
         sys.exit(1)
     
+    if BOT_PROCESSES > 1:
+        try:
+            run_launcher()
+        except KeyboardInterrupt:
+            logger.info("👋 Остановка по Ctrl+C")
+        finally:
+            ytdl_pool.shutdown(wait=False)
+            cache_manager.close()
+        sys.exit(0)
+    
     try:
         logger.info("🚀 Запуск бота...")
         bot.run(TOKEN)
@@ -1055,4 +3696,6 @@ if __name__ == "__main__":
         logger.error(f"❌ Критическая ошибка: {e}")
         sys.exit(1)
     finally:
-        ytdl_pool.executor.shutdown(wait=True)
+        ytdl_pool.shutdown(wait=True)
+        audio_workers.shutdown()
+        cache_manager.close()
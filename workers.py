@@ -0,0 +1,204 @@
+import itertools
+import json
+import sys
+import threading
+from multiprocessing.connection import Connection
+
+import discord
+from discord.opus import Encoder
+
+BATCH_FRAMES = 10
+
+def open_source(url, codec, before_options, passthrough):
+    if passthrough and codec == "opus":
+        return discord.FFmpegOpusAudio(
+            url,
+            codec="opus",
+            before_options=before_options,
+            options='-vn'
+        )
+
+    return discord.FFmpegPCMAudio(
+        url,
+        before_options=before_options,
+        options='-vn -bufsize 512k'
+    )
+
+class AudioStream(threading.Thread):
+    def __init__(self, stream_id, send, url, codec, before_options, passthrough, buffer_frames):
+        super().__init__(name=f"AudioStream-{stream_id}", daemon=True)
+        self.stream_id = stream_id
+        self.send = send
+        self.args = (url, codec, before_options, passthrough)
+        self.credits = threading.Semaphore(buffer_frames)
+        self.stopped = threading.Event()
+
+    def stop(self):
+        self.stopped.set()
+        self.credits.release()
+
+    def flush(self, batch):
+        if batch:
+            self.send(("frames", self.stream_id, batch))
+        return []
+
+    def run(self):
+        error = None
+        try:
+            source = open_source(*self.args)
+            encoder = None if source.is_opus() else Encoder()
+            try:
+                batch = []
+                while not self.stopped.is_set():
+                    if not self.credits.acquire(blocking=False):
+                        batch = self.flush(batch)
+                        self.credits.acquire()
+                        if self.stopped.is_set():
+                            break
+
+                    data = source.read()
+                    if not data:
+                        break
+                    if encoder:
+                        data = encoder.encode(data, encoder.SAMPLES_PER_FRAME)
+
+                    batch.append(data)
+                    if len(batch) >= BATCH_FRAMES:
+                        batch = self.flush(batch)
+
+                self.flush(batch)
+            finally:
+                source.cleanup()
+        except Exception as e:
+            error = str(e)
+
+        if not self.stopped.is_set():
+            self.send(("end", self.stream_id, error))
+
+def audio_worker_main(conn, buffer_frames):
+    send_lock = threading.Lock()
+    streams = {}
+
+    def send(message):
+        with send_lock:
+            try:
+                conn.send(message)
+            except (OSError, ValueError):
+                pass
+
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            break
+
+        kind, stream_id = message[0], message[1]
+        if kind == "open":
+            url, codec, before_options, passthrough = message[2:]
+            stream = AudioStream(stream_id, send, url, codec, before_options, passthrough, buffer_frames)
+            streams[stream_id] = stream
+            stream.start()
+        elif kind == "credit":
+            stream = streams.get(stream_id)
+            if stream:
+                stream.credits.release(message[2])
+        elif kind == "close":
+            stream = streams.pop(stream_id, None)
+            if stream:
+                stream.stop()
+        elif kind == "stop":
+            break
+
+    for stream in streams.values():
+        stream.stop()
+
+INFO_FIELDS = (
+    "_type", "ie_key", "id", "title", "url", "webpage_url", "thumbnail", "duration",
+    "acodec", "vcodec", "ext", "height", "format_id",
+)
+FORMAT_FIELDS = ("url", "acodec", "vcodec", "ext", "height", "format_id")
+
+def compact_info(info):
+    if not info:
+        return info
+
+    result = {key: info[key] for key in INFO_FIELDS if info.get(key) is not None}
+    if not result.get("thumbnail") and info.get("thumbnails"):
+        result["thumbnail"] = info["thumbnails"][-1].get("url")
+    if info.get("formats"):
+        result["formats"] = [
+            {key: fmt[key] for key in FORMAT_FIELDS if fmt.get(key) is not None}
+            for fmt in info["formats"]
+        ]
+    if info.get("entries") is not None:
+        result["entries"] = [compact_info(entry) for entry in info["entries"] if entry]
+    return result
+
+def stream_entries(ytdl, url, limit, on_entry):
+    # process=False отдает записи плейлиста по мере загрузки страниц
+    info = ytdl.extract_info(url, download=False, process=False)
+    if info and "entries" not in info:
+        info = ytdl.process_ie_result(info, download=False)
+    if not info:
+        return None
+
+    for entry in itertools.islice(info.get("entries") or (), limit):
+        if entry:
+            on_entry(entry)
+    return {"title": info.get("title")}
+
+def download_audio(ytdl, url):
+    info = ytdl.extract_info(url, download=True)
+    return {"path": ytdl.prepare_filename(info), "acodec": info.get("acodec"), "title": info.get("title")}
+
+def extraction_worker_main(conn):
+    import yt_dlp
+
+    instances = {}
+    jobs = 0
+
+    def get_ytdl(opts):
+        key = json.dumps(opts, sort_keys=True, default=str)
+        ytdl = instances.get(key)
+        if ytdl is None:
+            ytdl = instances[key] = yt_dlp.YoutubeDL(opts)
+        return ytdl
+
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            break
+
+        kind = message[0]
+        if kind == "ping":
+            conn.send(("pong", jobs))
+            continue
+        if kind == "stop":
+            break
+
+        jobs += 1
+        try:
+            ytdl = get_ytdl(message[1])
+            if kind == "extract":
+                result = compact_info(ytdl.extract_info(message[2], download=False))
+            elif kind == "entries":
+                result = stream_entries(
+                    ytdl, message[2], message[3], lambda entry: conn.send(("entry", compact_info(entry)))
+                )
+            elif kind == "download":
+                result = download_audio(ytdl, message[2])
+            else:
+                raise ValueError(f"unknown job {kind}")
+            conn.send(("result", result))
+        except Exception as e:
+            cause = getattr(e, "exc_info", None)
+            cause = cause[1] if cause else e
+            expected = isinstance(cause, yt_dlp.utils.ExtractorError) and cause.expected
+            conn.send(("error", str(e), expected))
+
+if __name__ == "__main__":
+    if sys.argv[1] == "audio":
+        audio_worker_main(Connection(int(sys.argv[2])), int(sys.argv[3]))
+    elif sys.argv[1] == "extract":
+        extraction_worker_main(Connection(int(sys.argv[2])))